@@ -0,0 +1,68 @@
+-- Price history freshness is persisted on quotes, and drives the refresh_price_history schedule
+
+ALTER TABLE quote
+ADD COLUMN history_date datetime AFTER cash_equivalent,
+ADD INDEX quote_history_date (history_date)
+;
+
+UPDATE quote Q
+   SET Q.history_date = (SELECT MAX(H.as_of_date) FROM price_history H WHERE H.quote_id = Q.id)
+;
+
+-- END SEGMENT
+
+-- Lot builder checkpoints, resumed by incremental position rebuilds
+
+CREATE TABLE `position_checkpoint` (
+    `id` integer AUTO_INCREMENT NOT NULL PRIMARY KEY,
+    `portfolio_id` integer NOT NULL,
+    `as_of_date` date NOT NULL,
+    `state` longtext NOT NULL,
+    UNIQUE (`portfolio_id`, `as_of_date`)
+) Engine=InnoDB;
+
+ALTER TABLE `position_checkpoint` ADD CONSTRAINT `position_checkpoint_portfolio_fk1` FOREIGN KEY (`portfolio_id`) REFERENCES `portfolio` (`id`);
+
+-- END SEGMENT
+
+-- Positions are only stored when they change, rebuild them all (they are rebuilt on the next view of each portfolio)
+
+DELETE FROM lot;
+DELETE FROM position;
+DELETE FROM position_checkpoint;
+
+CREATE INDEX `position_portfolio_symbol_as_of_date` ON `position` (`portfolio_id`, `symbol`, `as_of_date`);
+
+-- END SEGMENT
+
+-- Lot relief method (FIFO, LIFO, HIFO or AVERAGE) selectable per portfolio
+
+ALTER TABLE portfolio
+ADD COLUMN lot_relief_method varchar(10) NOT NULL DEFAULT 'FIFO' AFTER create_date
+;
+
+-- END SEGMENT
+
+-- Materialized daily portfolio values, filled by position rebuilds (all positions are rebuilt after the segment above)
+
+CREATE TABLE `portfolio_daily_value` (
+    `id` integer AUTO_INCREMENT NOT NULL PRIMARY KEY,
+    `portfolio_id` integer NOT NULL,
+    `as_of_date` date NOT NULL,
+    `market_value` double precision NOT NULL,
+    `deposit` double precision NOT NULL,
+    `withdrawal` double precision NOT NULL,
+    UNIQUE (`portfolio_id`, `as_of_date`)
+) Engine=InnoDB;
+
+ALTER TABLE `portfolio_daily_value` ADD CONSTRAINT `portfolio_daily_value_portfolio_fk1` FOREIGN KEY (`portfolio_id`) REFERENCES `portfolio` (`id`);
+
+-- END SEGMENT
+
+-- Earliest date to rebuild positions from, marked with every change and cleared by the rebuild
+
+ALTER TABLE portfolio
+ADD COLUMN positions_refresh_date date NULL AFTER lot_relief_method
+;
+
+-- END SEGMENT
@@ -3,15 +3,18 @@
 # see LICENSE file for copying permission.
 
 from django import forms
+from django.db.transaction import commit_on_success
 from django.shortcuts import redirect
 
 from main.decorators import login_required_decorator
 from main.decorators import portfolio_manipulation_decorator
+from main.models import LOT_RELIEF_METHODS
 from main.models import Portfolio
 from main.models import create_portfolio
 from main.view_utils import logout_user 
 from main.view_utils import redirect_to_portfolio_action
 from main.view_utils import render_page
+from positions.models import refresh_positions_in_background
 
 #-------------\
 #  CONSTANTS  |
@@ -23,7 +26,7 @@ from main.view_utils import render_page
 
 @login_required_decorator
 def account(request, user):
-  return render_page('account.html', request)
+  return render_page('account.html', request, extra_dictionary = { 'lot_relief_methods' : LOT_RELIEF_METHODS })
 
 @login_required_decorator
 def remove(request, user):
@@ -47,7 +50,19 @@ def set_portfolio_name(request, user, portfolio, is_sample, read_only):
   form = PortfolioNameForm(request.POST)
   if form.is_valid():
     portfolio.name = _get_effective_portfolio_name(user, form.cleaned_data.get('portfolioName').encode('UTF-8'))
-    portfolio.save()
+    Portfolio.objects.filter(id = portfolio.id).update(name = portfolio.name)
+    
+  return redirect("/account.html")
+
+@login_required_decorator
+@portfolio_manipulation_decorator
+@commit_on_success
+def set_lot_relief_method(request, user, portfolio, is_sample, read_only):
+  form = LotReliefMethodForm(request.POST)
+  if form.is_valid() and form.cleaned_data.get('lotReliefMethod') != portfolio.lot_relief_method:
+    portfolio.lot_relief_method = form.cleaned_data.get('lotReliefMethod').encode('UTF-8')
+    Portfolio.objects.filter(id = portfolio.id).update(lot_relief_method = portfolio.lot_relief_method)
+    refresh_positions_in_background(portfolio)
     
   return redirect("/account.html")
 
@@ -64,6 +79,9 @@ def remove_portfolio(request, user, portfolio, is_sample, read_only):
 class PortfolioNameForm(forms.Form):
   portfolioName = forms.CharField(min_length = 3, max_length = 30)
 
+class LotReliefMethodForm(forms.Form):
+  lotReliefMethod = forms.ChoiceField(choices = LOT_RELIEF_METHODS)
+
 #-------------------\
 #  LOCAL FUNCTIONS  |
 #-------------------/
@@ -0,0 +1,125 @@
+# Copyright (c) 2011 Gennadiy Shafranovich
+# Licensed under the MIT license
+# see LICENSE file for copying permission.
+
+from django.db import connection
+from django.db import transaction
+
+from settings import DATABASE_ENGINE
+
+#-------------\
+#  CONSTANTS  |
+#-------------/
+
+# maximum number of rows written or removed by a single bulk statement
+BULK_BATCH_SIZE = 500
+
+#---------------------\
+#  EXPOSED FUNCTIONS  |
+#---------------------/
+
+def batches(items, size = BULK_BATCH_SIZE):
+  """Split the given list into consecutive lists of at most size items."""
+
+  return [ items[i:(i + size)] for i in range(0, len(items), size) ]
+
+def bulk_insert(table, columns, rows, batch_size = BULK_BATCH_SIZE):
+  """Insert the given rows (tuples of column values) into a table with one multi-row INSERT per batch.
+     Must be called under transaction management (e.g. within transaction.commit_on_success)."""
+
+  if len(rows) == 0:
+    return
+
+  column_list = ', '.join([ _quote_name(column) for column in columns ])
+  row_placeholder = '(%s)' % ', '.join([ '%s' ] * len(columns))
+
+  cursor = connection.cursor()
+  try:
+    for batch in batches(rows, batch_size):
+      query = 'INSERT INTO %s (%s) VALUES %s' % (_quote_name(table), column_list, ', '.join([ row_placeholder ] * len(batch)))
+      cursor.execute(query, [ value for row in batch for value in row ])
+
+  finally:
+    cursor.close()
+
+  transaction.set_dirty()
+
+def bulk_update(table, column, values_by_id, batch_size = BULK_BATCH_SIZE):
+  """Update a single column for many rows, keyed by id, with one multi-row UPDATE per batch.
+     Must be called under transaction management (e.g. within transaction.commit_on_success)."""
+
+  if len(values_by_id) == 0:
+    return
+
+  cursor = connection.cursor()
+  try:
+    for batch in batches(values_by_id.items(), batch_size):
+      query = 'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+          _quote_name(table),
+          _quote_name(column),
+          _quote_name('id'),
+          ' '.join([ 'WHEN %s THEN %s' ] * len(batch)),
+          _quote_name('id'),
+          ', '.join([ '%s' ] * len(batch)),
+        )
+
+      cursor.execute(query, [ value for pair in batch for value in pair ] + [ id for id, value in batch ])
+
+  finally:
+    cursor.close()
+
+  transaction.set_dirty()
+
+def bulk_delete(table, ids, batch_size = BULK_BATCH_SIZE):
+  """Delete rows from a table by id with one DELETE per batch, bypassing the ORM's cascade collection.
+     Must be called under transaction management (e.g. within transaction.commit_on_success)."""
+
+  if len(ids) == 0:
+    return
+
+  cursor = connection.cursor()
+  try:
+    for batch in batches(list(ids), batch_size):
+      query = 'DELETE FROM %s WHERE %s IN (%s)' % (_quote_name(table), _quote_name('id'), ', '.join([ '%s' ] * len(batch)))
+      cursor.execute(query, batch)
+
+  finally:
+    cursor.close()
+
+  transaction.set_dirty()
+
+def advisory_lock(name, timeout):
+  """Take a named lock shared by every process using the database (MySQL GET_LOCK), waiting at most timeout
+     seconds. Returns False if the lock was not taken. Other databases have no named locks, there the lock is
+     always taken and only in-process locking applies."""
+
+  if DATABASE_ENGINE != 'mysql':
+    return True
+
+  cursor = connection.cursor()
+  try:
+    cursor.execute('SELECT GET_LOCK(%s, %s)', [ name, timeout ])
+    return (cursor.fetchone()[0] == 1)
+
+  finally:
+    cursor.close()
+
+def release_advisory_lock(name):
+  """Release a named lock taken with advisory_lock."""
+
+  if DATABASE_ENGINE != 'mysql':
+    return
+
+  cursor = connection.cursor()
+  try:
+    cursor.execute('SELECT RELEASE_LOCK(%s)', [ name ])
+
+  finally:
+    cursor.close()
+
+#-------------------\
+#  LOCAL FUNCTIONS  |
+#-------------------/
+
+def _quote_name(name):
+  return connection.ops.quote_name(name)
@@ -15,6 +15,13 @@ from django.db import models
 
 TOKEN_LETTERS = string.digits + string.uppercase + string.lowercase
 
+LOT_RELIEF_METHODS = (
+    ('FIFO', 'First In, First Out'),
+    ('LIFO', 'Last In, First Out'),
+    ('HIFO', 'Highest Cost First'),
+    ('AVERAGE', 'Average Cost'),
+  )
+
 #----------\
 #  MODELS  |
 #----------/
@@ -35,6 +42,11 @@ class Portfolio(models.Model):
   name = models.CharField(max_length = 30)
   read_only_token = models.CharField(max_length = 20, unique = True)
   create_date = models.DateTimeField()
+  lot_relief_method = models.CharField(max_length = 10, choices = LOT_RELIEF_METHODS, default = 'FIFO')
+  
+  # earliest date the positions need rebuilding from, written by the positions app with single column updates 
+  # only, so portfolios are never saved whole once created
+  positions_refresh_date = models.DateField(null = True)
   
   class Meta:
     db_table = 'portfolio'
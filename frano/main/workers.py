@@ -0,0 +1,120 @@
+# Copyright (c) 2011 Gennadiy Shafranovich
+# Licensed under the MIT license
+# see LICENSE file for copying permission.
+
+from Queue import Queue
+from threading import Event
+from threading import Lock
+from threading import Thread
+from traceback import print_exc
+
+from django.db import connection
+
+#-----------------\
+#  VALUE OBJECTS  |
+#-----------------/
+
+class WorkerPool:
+  """A set of background daemon threads running queued jobs off the request path. Jobs are queued under
+     a key, and a job submitted while another job with the same key is still waiting to run is coalesced
+     into the waiting job. Jobs with the same key never run at the same time."""
+
+  def __init__(self, name, threads):
+    self.name = name
+    self.threads = threads
+    self.queue = Queue()
+    self.lock = Lock()
+    self.pending = { }
+    self.running = { }
+    self.workers = []
+
+  def __repr__(self):
+    return "WorkerPool %s: %d pending, %d running" % (self.name, len(self.pending), len(self.running))
+
+  def submit(self, key, function, *args):
+    self.lock.acquire()
+    try:
+      job = self.pending.get(key)
+      if job == None:
+        job = Job(key, function, args)
+        self.pending[key] = job
+        self.queue.put(job)
+        self._start_workers()
+
+      return job
+
+    finally:
+      self.lock.release()
+
+  def wait(self, key, timeout = None):
+    """Wait for any pending or running job under the given key, returns False if the wait timed out."""
+
+    self.lock.acquire()
+    try:
+      jobs = [ job for job in [ self.running.get(key), self.pending.get(key) ] if job != None ]
+    finally:
+      self.lock.release()
+
+    for job in jobs:
+      job.done.wait(timeout)
+      if not job.done.isSet():
+        return False
+
+    return True
+
+  def _start_workers(self):
+    while len(self.workers) < self.threads:
+      worker = Thread(target = self._work, name = ('%s-%d' % (self.name, len(self.workers))))
+      worker.setDaemon(True)
+      worker.start()
+      self.workers.append(worker)
+
+  def _work(self):
+    while True:
+      job = self.queue.get()
+
+      # a job stays pending, taking in new submissions, until the running job with its key is done
+      self.lock.acquire()
+      try:
+        while self.running.has_key(job.key):
+          running = self.running[job.key]
+          self.lock.release()
+          try:
+            running.done.wait()
+          finally:
+            self.lock.acquire()
+
+        if self.pending.get(job.key) is job:
+          del(self.pending[job.key])
+
+        self.running[job.key] = job
+      finally:
+        self.lock.release()
+
+      try:
+        job.function(*job.args)
+
+      except Exception:
+        print_exc()
+
+      finally:
+        self.lock.acquire()
+        try:
+          if self.running.get(job.key) is job:
+            del(self.running[job.key])
+        finally:
+          self.lock.release()
+
+        # each worker thread holds its own database connection, release it between jobs
+        connection.close()
+        job.done.set()
+
+class Job:
+  def __init__(self, key, function, args):
+    self.key = key
+    self.function = function
+    self.args = args
+    self.done = Event()
+
+  def __repr__(self):
+    return "Job: %s" % (self.key, )
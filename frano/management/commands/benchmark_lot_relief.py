@@ -0,0 +1,91 @@
+# Copyright (c) 2011 Gennadiy Shafranovich
+# Licensed under the MIT license
+# see LICENSE file for copying permission.
+
+import random
+
+from datetime import date
+from datetime import timedelta
+from optparse import make_option
+from sys import stdout
+from time import time
+
+from django.core.management.base import BaseCommand
+
+from frano.main.models import LOT_RELIEF_METHODS
+from frano.positions.models import LotBuilder
+from frano.positions.models import Position
+
+class Command(BaseCommand):
+  help = 'Benchmarks the lot relief methods on a synthetic high frequency portfolio'
+  option_list = BaseCommand.option_list + (
+      make_option('--trades',
+          type = 'int',
+          dest = 'trades',
+          default = 20000,
+          help = 'Number of synthetic trades per symbol'
+        ),
+      make_option('--symbols',
+          type = 'int',
+          dest = 'symbols',
+          default = 5,
+          help = 'Number of synthetic symbols'
+        ),
+      make_option('--seed',
+          type = 'int',
+          dest = 'seed',
+          default = 1,
+          help = 'Random seed of the synthetic trades'
+        ),
+    )
+
+  def handle(self, *args, **options):
+    trades = self._synthetic_trades(options.get('trades'), options.get('seed'))
+    stdout.write('Replaying %d trades on each of %d symbols\n' % (len(trades), options.get('symbols')))
+    
+    for method, name in LOT_RELIEF_METHODS:
+      start = time()
+      builders = [ LotBuilder(method) for i in range(options.get('symbols')) ]
+      for builder in builders:
+        for trade in trades:
+          builder.add_transaction(trade)
+      
+      replay_elapsed = time() - start
+      lots = sum([ len(builder.get_lots()) for builder in builders ])
+      elapsed = time() - start
+      
+      position = builders[0].compose(Position(quantity = 0.0, cost_price = 0.0, cost_basis = 0.0, realized_pl = 0.0))
+      stdout.write('%s: %d lots in %.3fs (replay %.3fs, %.0f trades/s), realized p/l %.2f, open cost %.2f\n' % (
+          method,
+          lots,
+          elapsed,
+          replay_elapsed,
+          (((len(trades) * len(builders)) / replay_elapsed) if replay_elapsed > 0 else 0),
+          position.realized_pl,
+          position.cost_basis,
+        ))
+  
+  def _synthetic_trades(self, count, seed):
+    """A random walk of partial fills around a slowly drifting price, leaning to buys so lots accumulate."""
+    
+    generator = random.Random(seed)
+    as_of_date = date.today() - timedelta(days = (count / 20))
+    price = 50.0
+    out = []
+    for i in range(count):
+      if i % 20 == 0:
+        as_of_date += timedelta(days = 1)
+        
+      price = max(1.0, price * (1.0 + generator.gauss(0.0, 0.01)))
+      quantity = float(generator.randint(1, 20) * 5)
+      out.append(SyntheticTrade((generator.random() < 0.55 and 'BUY' or 'SELL'), as_of_date, quantity, price, (quantity * price) + 1.0))
+    
+    return out
+
+class SyntheticTrade:
+  def __init__(self, type, as_of_date, quantity, price, total):
+    self.type = type
+    self.as_of_date = as_of_date
+    self.quantity = quantity
+    self.price = price
+    self.total = total
@@ -0,0 +1,88 @@
+# Copyright (c) 2011 Gennadiy Shafranovich
+# Licensed under the MIT license
+# see LICENSE file for copying permission.
+
+from optparse import make_option
+from sys import stdout
+from time import time
+
+from django.core.management.base import BaseCommand
+
+from frano.main.models import Portfolio
+from frano.positions.models import daily_values
+from frano.positions.models import numpy
+
+ENGINES = [ 'SQL', 'PYTHON' ]
+
+class Command(BaseCommand):
+  help = 'Benchmarks the daily portfolio value engines against each other'
+  args = '[portfolio_id ...]'
+  option_list = BaseCommand.option_list + (
+      make_option('--repeat',
+          type = 'int',
+          dest = 'repeat',
+          default = 3,
+          help = 'Number of times each engine values each portfolio'
+        ),
+      make_option('--engine',
+          dest = 'engine',
+          default = None,
+          help = 'Only run the given engine (SQL or PYTHON), skipping the comparison'
+        ),
+    )
+
+  def handle(self, *args, **options):
+    portfolios = Portfolio.objects.order_by('id')
+    if len(args) > 0:
+      portfolios = portfolios.filter(id__in = [ int(id) for id in args ])
+
+    portfolios = list(portfolios)
+    engines = ([ options.get('engine') ] if options.get('engine') != None else list(ENGINES))
+    if numpy == None and 'PYTHON' in engines:
+      stdout.write('NumPy is not installed, skipping the PYTHON engine\n')
+      engines.remove('PYTHON')
+
+    repeat = options.get('repeat')
+    stdout.write('Valuing %d portfolios %d times with %s\n' % (len(portfolios), repeat, ', '.join(engines)))
+
+    elapsed = dict([ (engine, 0.0) for engine in engines ])
+    rows = dict([ (engine, 0) for engine in engines ])
+    mismatched = 0
+    for portfolio in portfolios:
+      values = { }
+      for engine in engines:
+        start = time()
+        for i in range(repeat):
+          values[engine] = daily_values(portfolio, engine = engine)
+
+        elapsed[engine] += time() - start
+        rows[engine] += len(values[engine])
+
+      if len(engines) > 1 and not self._same_values(values[engines[0]], values[engines[1]]):
+        stdout.write('Engines disagree on portfolio %d\n' % portfolio.id)
+        mismatched += 1
+
+    for engine in engines:
+      stdout.write('%s: %d rows in %.3fs (%.1f portfolios/s)\n' % (
+          engine,
+          rows[engine],
+          elapsed[engine],
+          (((len(portfolios) * repeat) / elapsed[engine]) if elapsed[engine] > 0 else 0),
+        ))
+
+    if len(engines) > 1:
+      stdout.write('%d of %d portfolios differ between engines\n' % (mismatched, len(portfolios)))
+
+  def _same_values(self, left, right):
+    if len(left) != len(right):
+      return False
+
+    for left_row, right_row in zip(left, right):
+      if left_row[0] != right_row[0]:
+        return False
+
+      for left_value, right_value in zip(left_row[1:], right_row[1:]):
+        if abs(left_value - right_value) > 0.01:
+          return False
+
+    return True
@@ -0,0 +1,80 @@
+# Copyright (c) 2011 Gennadiy Shafranovich
+# Licensed under the MIT license
+# see LICENSE file for copying permission.
+
+import json
+
+from datetime import datetime
+from datetime import timedelta
+from optparse import make_option
+from sys import stdout
+from time import time
+
+from django.core.management.base import BaseCommand
+
+from frano.quotes.models import PRICE_HISTORY_LIMIT_IN_DAYS
+from frano.quotes.models import QUOTE_FETCH_CHUNK_SIZE
+from frano.quotes.models import Quote
+from frano.quotes.providers import get_quote_provider
+from frano.quotes.providers import record_quote_fixture
+
+class Command(BaseCommand):
+  help = 'Benchmarks the configured quote provider, or records a fixture for the local provider'
+  args = '[symbol ...]'
+  option_list = BaseCommand.option_list + (
+      make_option('--history',
+          action = 'store_true',
+          dest = 'history',
+          default = False,
+          help = 'Also benchmark price history retrieval for every symbol'
+        ),
+      make_option('--record',
+          dest = 'record',
+          default = None,
+          help = 'Record the quotes and price history of the symbols to the given fixture file instead'
+        ),
+    )
+
+  def handle(self, *args, **options):
+    provider = get_quote_provider()
+    symbols = (list(args) if len(args) > 0 else [ quote.symbol for quote in Quote.objects.all() ])
+    end_date = datetime.now() + timedelta(days = 1)
+    start_date = end_date - timedelta(days = PRICE_HISTORY_LIMIT_IN_DAYS)
+    stdout.write('Using %s for %d symbols\n' % (provider, len(symbols)))
+
+    if options.get('record') != None:
+      f = open(options.get('record'), 'w')
+      try:
+        json.dump(record_quote_fixture(provider, symbols, start_date, end_date), f)
+      finally:
+        f.close()
+
+      stdout.write('Successfully recorded fixture to %s\n' % options.get('record'))
+      return
+
+    start = time()
+    rows = 0
+    requests = 0
+    for i in range(0, len(symbols), QUOTE_FETCH_CHUNK_SIZE):
+      rows += len(provider.quotes(symbols[i:(i + QUOTE_FETCH_CHUNK_SIZE)]))
+      requests += 1
+
+    self._report('Quotes', requests, rows, time() - start)
+
+    if options.get('history'):
+      start = time()
+      rows = 0
+      for symbol in symbols:
+        rows += len(provider.price_history(symbol, start_date, end_date))
+
+      self._report('Price history', len(symbols), rows, time() - start)
+
+  def _report(self, name, requests, rows, elapsed):
+    stdout.write('%s: %d requests, %d rows in %.3fs (%.1f requests/s, %.1f rows/s)\n' % (
+        name,
+        requests,
+        rows,
+        elapsed,
+        ((requests / elapsed) if elapsed > 0 else 0),
+        ((rows / elapsed) if elapsed > 0 else 0),
+      ))
@@ -9,7 +9,7 @@ from django.db import connection
 
 from frano.main.demo import DEMO_INSTRUMENTS
 from frano.quotes.models import Quote
-from frano.positions.views import PERFORMANCE_BENCHMARK_SYMBOL
+from frano.positions.views import PERFORMANCE_BENCHMARK_SYMBOLS
 
 class Command(BaseCommand):
   help = 'Cleanup any quotes and price history that are unused'
@@ -35,7 +35,7 @@ class Command(BaseCommand):
       
     cursor.close()
     
-    symbols.difference_update(DEMO_INSTRUMENTS + [ PERFORMANCE_BENCHMARK_SYMBOL ])
+    symbols.difference_update(DEMO_INSTRUMENTS + PERFORMANCE_BENCHMARK_SYMBOLS)
     unused = Quote.objects.filter(symbol__in = symbols)
     stdout.write('Found %d unused quotes\n' % unused.count())
     
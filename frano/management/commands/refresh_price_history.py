@@ -2,22 +2,89 @@
 # Licensed under the MIT license
 # see LICENSE file for copying permission.
 
+from datetime import datetime
+from datetime import timedelta
+from optparse import make_option
 from sys import stdout
+from time import time
 
 from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db.models import Q
 
+from frano.positions.models import refresh_daily_values_for_symbols
 from frano.quotes.models import Quote
 from frano.quotes.models import refresh_price_history
+from frano.quotes.providers import ProviderUnavailableError
+
+# quotes refreshed within this window are skipped by incremental runs
+DEFAULT_SKIP_WINDOW_IN_MINUTES = 60
+
+# a run stops cleanly, leaving the remaining (least stale) quotes to the next run, after this long
+DEFAULT_TIME_BUDGET_IN_MINUTES = 60
 
 class Command(BaseCommand):
-  help = 'Refreshes the price history for all quotes'
+  help = 'Refreshes the price history for all quotes, stalest first'
+  option_list = BaseCommand.option_list + (
+      make_option('--full',
+          action = 'store_true',
+          dest = 'full',
+          default = False,
+          help = 'Reconcile the full price history window instead of only the days since the last refresh'
+        ),
+      make_option('--skip-minutes',
+          type = 'int',
+          dest = 'skip_minutes',
+          default = DEFAULT_SKIP_WINDOW_IN_MINUTES,
+          help = 'Skip quotes refreshed within this many minutes (incremental runs only)'
+        ),
+      make_option('--budget-minutes',
+          type = 'int',
+          dest = 'budget_minutes',
+          default = DEFAULT_TIME_BUDGET_IN_MINUTES,
+          help = 'Stop after this many minutes, leaving the remaining quotes for the next run'
+        ),
+    )
 
   def handle(self, *args, **options):
-    quotes = Quote.objects.all()
-    
-    stdout.write('Found %d quotes to refresh price history\nStarting...\n' % quotes.count())
+    full = options.get('full', False)
+    budget = options.get('budget_minutes') * 60
+
+    quotes = Quote.objects.filter(cash_equivalent = False)
+    if not full:
+      cutoff = datetime.now() - timedelta(minutes = options.get('skip_minutes'))
+      quotes = quotes.filter(Q(history_date__isnull = True) | Q(history_date__lt = cutoff))
+
+    quotes = list(quotes.order_by('history_date'))
+
+    stdout.write('Found %d quotes to refresh price history (%s)\nStarting...\n' % (len(quotes), ('full' if full else 'incremental')))
+    start = time()
+    refreshed = 0
+    changed_dates = { }
+    unavailable = False
     for quote in quotes:
+      if (time() - start) > budget:
+        stdout.write('Time budget reached, leaving %d quotes for the next run\n' % (len(quotes) - refreshed))
+        break
+
       stdout.write('Refreshing price history for: %s\n' % quote.symbol)
-      refresh_price_history(quote)
-    
+      refreshed += 1
+      try:
+        refresh_price_history(quote, full)
+        if quote.history_changed_date != None:
+          changed_dates[quote.symbol] = quote.history_changed_date
+
+      except ProviderUnavailableError:
+        stdout.write('Quote provider is unavailable, stopping\n')
+        unavailable = True
+        break
+
+      except IOError, e:
+        stdout.write('Failed to refresh price history for: %s (%s)\n' % (quote.symbol, e))
+
+    stdout.write('Refreshing daily values of portfolios holding %d changed quotes\n' % len(changed_dates))
+    refresh_daily_values_for_symbols(changed_dates)
+    if unavailable:
+      raise CommandError('Quote provider is unavailable, stopped after %d of %d quotes' % (refreshed - 1, len(quotes)))
+
     stdout.write('Successfully refreshed priced history\n')
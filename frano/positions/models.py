@@ -2,21 +2,74 @@
 # Licensed under the MIT license
 # see LICENSE file for copying permission.
 
-from bisect import insort
+import json
+
+from collections import deque
+from datetime import date
 from datetime import datetime
+from heapq import heappop
+from heapq import heappush
+from itertools import count
+from threading import Lock
 
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
 from django.db import models
+from django.db import transaction
 
+from main.db_utils import advisory_lock
+from main.db_utils import bulk_delete
+from main.db_utils import bulk_insert
+from main.db_utils import release_advisory_lock
 from main.models import Portfolio
+from main.workers import WorkerPool
 from quotes.models import CASH_SYMBOL
+from quotes.models import QUOTE_WORKERS
+from quotes.models import Quote
+from quotes.models import price_series_for_quotes
+from settings import PERFORMANCE_HISTORY_ENGINE
 from transactions.models import Transaction
 
+# NumPy is optional, the array engine (daily_holdings) is only available when it is installed
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 #-------------\
 #  CONSTANTS  |
 #-------------/
 
 QUANTITY_TOLERANCE = 0.000001
 
+# lot builder state is checkpointed at the end of every month, keeping this many of the latest checkpoints
+POSITION_CHECKPOINTS_KEPT = 24
+
+# forced position refreshes run on background workers, one coalesced job per portfolio
+POSITION_REFRESH_THREADS = 2
+POSITION_WORKERS = WorkerPool('positions', POSITION_REFRESH_THREADS)
+
+# daily value refreshes wait for pending quotes, on their own workers so they never hold up position refreshes
+DAILY_VALUE_REFRESH_THREADS = 1
+DAILY_VALUE_WORKERS = WorkerPool('values', DAILY_VALUE_REFRESH_THREADS)
+
+# readers wait this long for a queued refresh, after which they see the previous positions
+POSITION_REFRESH_WAIT_IN_SECONDS = 30
+
+# earliest date to rebuild from (None for all) by portfolio id, merged until the queued refresh starts
+POSITION_REFRESH_DATES = { }
+POSITION_REFRESH_LOCK = Lock()
+
+# queued refreshes are also marked on the portfolio row with the earliest date to rebuild from, so they survive
+# a restart. Full rebuilds are marked with a date before any transaction
+EARLIEST_REFRESH_DATE = date(1900, 1, 1)
+
+# a portfolio is rebuilt by one caller at a time, under an in-process lock and a database advisory lock. The 
+# in-process locks are striped by portfolio id, a caller never holds more than one
+POSITION_LOCK_STRIPES = 16
+POSITION_LOCKS = [ Lock() for i in range(POSITION_LOCK_STRIPES) ]
+POSITION_LOCK_TIMEOUT_IN_SECONDS = 60
+
 #----------\
 #  MODELS  |
 #----------/
@@ -62,26 +115,57 @@ class Lot(models.Model):
         self.sold_total
       )
     
-  def __cmp__(self, other):
-    my_date = min([ date for date in [self.as_of_date, self.sold_as_of_date] if date is not None ])
-    other_date = min([ date for date in [other.as_of_date, other.sold_as_of_date] if date is not None ])
-    if my_date == other_date:
-      return 0
-    else:
-      return (-1 if my_date < other_date else 1)
+class PositionCheckpoint(models.Model):
+  portfolio = models.ForeignKey(Portfolio)
+  as_of_date = models.DateField()
+  state = models.TextField()
+  
+  class Meta:
+    db_table = 'position_checkpoint'
+    unique_together = (( 'portfolio', 'as_of_date' ))
+    
+  def __unicode__(self):
+    return "Checkpoint of %d on %s" % (self.portfolio.id, self.as_of_date.strftime('%m/%d/%Y'))
+
+class PortfolioDailyValue(models.Model):
+  portfolio = models.ForeignKey(Portfolio)
+  as_of_date = models.DateField()
+  market_value = models.FloatField()
+  deposit = models.FloatField()
+  withdrawal = models.FloatField()
+  
+  class Meta:
+    db_table = 'portfolio_daily_value'
+    unique_together = (( 'portfolio', 'as_of_date' ))
+    
+  def __unicode__(self):
+    return "%.2f on %s" % (self.market_value, self.as_of_date.strftime('%m/%d/%Y'))
   
 #------------\
 #  SERVICES  |
 #------------/
 
-def latest_positions(portfolio):
-  """Retrieve a list of latest positions for the given portfolio."""
+def latest_positions(portfolio, as_of_date = None):
+  """Retrieve a list of latest positions for the given portfolio, optionally as of the given date. Positions are
+     only stored when they change, so this is the latest stored position of each symbol."""
   
-  latest_date = Position.objects.filter(portfolio__id__exact = portfolio.id).dates('as_of_date', 'day', order = 'DESC')[0:1]
-  if latest_date.count() > 0:
-    return Position.objects.filter(portfolio__id__exact = portfolio.id, as_of_date = latest_date[0]).order_by('symbol')
-  else:
-    return []
+  query = """
+      SELECT P.*
+        FROM position P
+             JOIN
+             (
+                 SELECT P.symbol,
+                        MAX(P.as_of_date) as as_of_date
+                   FROM position P
+                  WHERE P.portfolio_id = %s
+                    AND P.as_of_date <= %s
+               GROUP BY P.symbol
+             ) L ON (L.symbol = P.symbol AND L.as_of_date = P.as_of_date)
+       WHERE P.portfolio_id = %s
+    ORDER BY P.symbol"""
+  
+  as_of_date = (as_of_date if as_of_date != None else date.max)
+  return list(Position.objects.raw(query, [ portfolio.id, as_of_date, portfolio.id ]))
 
 def decorate_position_with_prices(position, price, previous_price):
   """Decorate the given position with various pieces of data that require pricing (p/l, market_value)"""
@@ -96,29 +180,207 @@ def decorate_position_with_prices(position, price, previous_price):
   position.day_pl = (position.market_value - position.previous_market_value)
   position.day_pl_percent = (((position.day_pl / position.previous_market_value) * 100) if position.previous_market_value != 0 else 0)
     
-def refresh_positions(portfolio, transactions = None, force = False):
-  """Refresh all positions in the given portfolio if needed or if the caller requests a forced refresh"""
+def refresh_positions(portfolio, transactions = None, force = False, from_date = None):
+  """Refresh all positions in the given portfolio if needed (never built, or marked for a refresh) or if the 
+     caller requests a forced refresh. A forced refresh can be limited to the positions on or after from_date, 
+     the earliest date affected by a change. Refreshes of a portfolio run one at a time, across threads and 
+     (on MySQL) processes."""
   
   if transactions == None:
     transactions = Transaction.objects.filter(portfolio__id__exact = portfolio.id)
     
-  positions = Position.objects.filter(portfolio__id__exact = portfolio.id)
-  if (transactions.count() > 0 and positions.count() == 0) or force:
-    positions.delete()
-    _refresh_positions_from_transactions(transactions)
+  if not force:
+    POSITION_WORKERS.wait(('positions', portfolio.id), POSITION_REFRESH_WAIT_IN_SECONDS)
+    if not _is_refresh_needed(portfolio, transactions):
+      return
+    
+  # single flight: concurrent callers wait for the rebuild in progress, then check again before repeating it
+  if not _lock_portfolio(portfolio):
+    if force:
+      _queue_refresh(portfolio, from_date)
+      
+    return
+  
+  try:
+    # end the current read snapshot, to see rebuilds committed by others while waiting
+    transaction.commit_unless_managed()
+    _refresh_positions_if_needed(portfolio, transactions, force, from_date)
+      
+  finally:
+    _unlock_portfolio(portfolio)
+
+def refresh_positions_in_background(portfolio, from_date = None):
+  """Mark the positions in the given portfolio for a refresh from the given date (or fully) and queue it. The
+     mark is written in the caller's transaction, which must be managed (e.g. commit_on_success) so that it 
+     commits with the change it is for, and refresh_positions rebuilds any marked portfolio even if the queued 
+     refresh never runs. Requests made before the queued refresh starts are coalesced into it, rebuilding from 
+     the earliest date requested. Readers going through refresh_positions wait for the queued refresh."""
+  
+  _mark_refresh(portfolio, from_date)
+  _queue_refresh(portfolio, from_date)
+
+def daily_values(portfolio, from_date = None, engine = None):
+  """Compute the daily values of the given portfolio on every trading day from the given date, or since its 
+     first position, as (date, market value, deposit, withdrawal) tuples. The engine is either SQL or PYTHON 
+     (needs NumPy), the PERFORMANCE_HISTORY_ENGINE setting by default."""
+  
+  if (engine or PERFORMANCE_HISTORY_ENGINE) == 'PYTHON':
+    if numpy == None:
+      raise ImproperlyConfigured('The PYTHON performance history engine requires NumPy')
+    
+    return _daily_values_in_python(portfolio, from_date)
+  else:
+    return _daily_values_in_sql(portfolio, from_date)
+
+def refresh_daily_values(portfolio, from_date = None):
+  """Recompute the stored daily values (market value, deposits and withdrawals) of the given portfolio on every
+     trading day from the given date, or since its first position. Position rebuilds do this on their own."""
+  
+  if not _lock_portfolio(portfolio):
+    return
+  
+  try:
+    transaction.commit_unless_managed()
+    transaction.commit_on_success(_save_daily_values)(portfolio, from_date)
+    
+  finally:
+    _unlock_portfolio(portfolio)
+
+def refresh_daily_values_for_symbols(from_date_by_symbol):
+  """Recompute the daily values of every portfolio holding any of the given symbols, from the earliest date 
+     given for its symbols (the earliest date of changed prices)."""
+  
+  from_date_by_portfolio = { }
+  if len(from_date_by_symbol) > 0:
+    holders = Position.objects.filter(symbol__in = from_date_by_symbol.keys()).values_list('portfolio', 'symbol').distinct()
+    for portfolio_id, symbol in holders:
+      from_date = from_date_by_symbol[symbol]
+      from_date_by_portfolio[portfolio_id] = min(from_date_by_portfolio.get(portfolio_id, from_date), from_date)
+  
+  for portfolio in Portfolio.objects.filter(id__in = from_date_by_portfolio.keys()):
+    refresh_daily_values(portfolio, from_date_by_portfolio[portfolio.id])
+
+def refresh_daily_values_in_background(portfolio, symbols):
+  """Queue a full refresh of the daily values of the given portfolio, to run once the quote workers are done
+     retrieving the quotes and price history of the given symbols."""
+  
+  DAILY_VALUE_WORKERS.submit(('values', portfolio.id), _refresh_daily_values_in_background, portfolio.id, list(symbols))
+
+def daily_holdings(portfolio, transactions = None):
+  """Compute the daily quantities, net cost and cash of the given portfolio with cumulative sums over arrays
+     of its transactions. No lots are matched, so cost is the net amount paid into each symbol. Returns None
+     when NumPy is not installed."""
+  
+  if numpy == None:
+    return None
+  
+  if transactions == None:
+    transactions = Transaction.objects.filter(portfolio__id__exact = portfolio.id)
+    
+  rows = list(transactions.values_list('as_of_date', 'type', 'symbol', 'quantity', 'total'))
+  dates = sorted(set([ row[0] for row in rows ]))
+  symbols = sorted(set([ row[2] for row in rows if row[1] in [ 'BUY', 'SELL' ] ]))
+  date_index = dict([ (as_of_date, i) for i, as_of_date in enumerate(dates) ])
+  symbol_index = dict([ (symbol, i) for i, symbol in enumerate(symbols) ])
+  
+  # cash moves with every transaction, quantities and cost only with trades
+  date_ids = numpy.array([ date_index[row[0]] for row in rows ], dtype = int)
+  cash_changes = numpy.array([ (-row[4] if row[1] in [ 'BUY', 'WITHDRAW' ] else row[4]) for row in rows ], dtype = float)
+  
+  trades = [ row for row in rows if row[1] in [ 'BUY', 'SELL' ] ]
+  trade_cells = numpy.array([ (date_index[row[0]] * len(symbols)) + symbol_index[row[2]] for row in trades ], dtype = int)
+  signs = numpy.array([ (1.0 if row[1] == 'BUY' else -1.0) for row in trades ], dtype = float)
+  quantity_changes = signs * numpy.array([ row[3] for row in trades ], dtype = float)
+  cost_changes = signs * numpy.array([ row[4] for row in trades ], dtype = float)
+  
+  shape = (len(dates), len(symbols))
+  quantities = _cumulative_by_cell(trade_cells, quantity_changes, shape)
+  quantities[numpy.abs(quantities) < QUANTITY_TOLERANCE] = 0.0
+  cost_basis = _cumulative_by_cell(trade_cells, cost_changes, shape)
+  cash = _cumulative_by_cell(date_ids, cash_changes, (len(dates), ))
+  
+  return DailyHoldings(dates, symbols, quantities, cost_basis, cash)
 
 #-----------------\
 #  VALUE OBJECTS  |
 #-----------------/
 
+class DailyHoldings:
+  """Daily holdings computed by daily_holdings: quantities and cost_basis are (dates x symbols) arrays, cash is
+     a (dates) array, all as of the end of each transaction date."""
+  
+  def __init__(self, dates, symbols, quantities, cost_basis, cash):
+    self.dates = dates
+    self.symbols = symbols
+    self.quantities = quantities
+    self.cost_basis = cost_basis
+    self.cash = cash
+    
+  def __repr__(self):
+    return "DailyHoldings: %d symbols over %d dates" % (len(self.symbols), len(self.dates))
+  
+  def positions(self, portfolio, index = -1):
+    """Unsaved positions (cash first, then by symbol) as of the given date index, the latest by default."""
+    
+    if len(self.dates) == 0:
+      return []
+    
+    as_of_date = self.dates[index]
+    out = [ Position(portfolio = portfolio, 
+        as_of_date = as_of_date, 
+        symbol = CASH_SYMBOL, 
+        quantity = float(self.cash[index]), 
+        cost_price = 1.0, 
+        cost_basis = float(self.cash[index]), 
+        realized_pl = 0.0
+      ) ]
+    
+    for i, symbol in enumerate(self.symbols):
+      quantity = float(self.quantities[index, i])
+      cost_basis = float(self.cost_basis[index, i])
+      out.append(Position(portfolio = portfolio, 
+          as_of_date = as_of_date, 
+          symbol = symbol, 
+          quantity = quantity, 
+          cost_price = ((cost_basis / quantity) if quantity != 0.0 else 0.0), 
+          cost_basis = (cost_basis if quantity != 0.0 else 0.0), 
+          realized_pl = 0.0
+        ))
+      
+    return out
+
 class LotBuilder:
-  def __init__(self):
-    self.long_half_lots = []
-    self.short_half_lots = []
+  """Matches buys and sells of a single symbol into lots. Open half lots are kept in lot pools that hand out
+     the next lot to relieve under the relief method (see LOT_RELIEF_METHODS), and closed lots are only sorted
+     when materialized."""
+  
+  def __init__(self, relief_method = 'FIFO'):
+    self.relief_method = relief_method
+    self.long_half_lots = _new_lot_pool(relief_method, False)
+    self.short_half_lots = _new_lot_pool(relief_method, True)
     self.closed_lots = []
+    self.realized_pl = 0.0
     
   def __repr__(self):
-    return "Open (Long):\n %s\n\nOpen (Short):\n %s\n\nClosed:\n %s" % (self.long_lots, self.short_lots, self.closed_lots)
+    return "Open (Long):\n %s\n\nOpen (Short):\n %s\n\nClosed:\n %s" % (list(self.long_half_lots), list(self.short_half_lots), self.closed_lots)
+  
+  def to_state(self):
+    return {
+        'long' : [ half_lot.to_state() for half_lot in self.long_half_lots.in_order() ],
+        'short' : [ half_lot.to_state() for half_lot in self.short_half_lots.in_order() ],
+        'closed' : [ lot.to_state() for lot in self.closed_lots ],
+      }
+  
+  def load_state(self, state):
+    for half_lot in state['long']:
+      self.long_half_lots.push(_half_lot_from_state(half_lot))
+      
+    for half_lot in state['short']:
+      self.short_half_lots.push(_half_lot_from_state(half_lot))
+      
+    self.closed_lots = [ _lot_value_from_state(lot) for lot in state['closed'] ]
+    self.realized_pl = sum([ (lot.sold_total - lot.total) for lot in self.closed_lots ])
+    return self
   
   def add_transaction(self, transaction):
     fees = transaction.total - (transaction.quantity * transaction.price)
@@ -130,22 +392,21 @@ class LotBuilder:
       poll = self.long_half_lots
       
     while quantity > 0 and len(poll) > 0:
-      half_lot = poll.pop(0)
+      half_lot = poll.peek()
       if (quantity - half_lot.quantity) > -QUANTITY_TOLERANCE:
+        poll.pop()
         partial_fees = fees * (half_lot.quantity / quantity)
         fees = fees - partial_fees
         quantity -= half_lot.quantity
-        insort(self.closed_lots, half_lot.close(transaction.as_of_date, transaction.price, partial_fees))
+        self._add_closed_lot(half_lot.close(transaction.as_of_date, transaction.price, partial_fees))
          
       else:
-        closed = half_lot.partial_close(transaction.as_of_date, quantity, transaction.price, fees)
-        poll.insert(0, half_lot)
-        insort(self.closed_lots, closed)
+        self._add_closed_lot(poll.split(quantity).close(transaction.as_of_date, transaction.price, fees))
         quantity = 0
         fees = 0
     
     if quantity > QUANTITY_TOLERANCE:
-      push.append(HalfLot(type = transaction.type,
+      push.push(HalfLot(type = transaction.type,
           as_of_date = transaction.as_of_date,
           quantity = quantity,
           price = transaction.price,
@@ -154,17 +415,47 @@ class LotBuilder:
     
     return self
   
+  def compose(self, position):
+    """Fill in the quantity, cost and realized p/l of the given position from the current lots, without
+       materializing them. Short lots carry no cost price."""
+    
+    total = 0.0
+    for half_lot in self.long_half_lots:
+      position.quantity += half_lot.quantity
+      position.cost_basis += half_lot.total
+      total += half_lot.quantity * half_lot.price
+      
+    for half_lot in self.short_half_lots:
+      position.quantity -= half_lot.quantity
+      position.cost_basis -= half_lot.total
+      
+    position.cost_price = (total / position.quantity if abs(position.quantity) > QUANTITY_TOLERANCE else 0.0)
+    position.realized_pl = self.realized_pl
+    if abs(position.quantity) < QUANTITY_TOLERANCE:
+      position.quantity = 0.0
+      
+    return position
+  
   def get_lots(self):
-    out = []
-    for lot in self.closed_lots:
-      insort(out, _clone_lot(lot))
+    """Materialize closed and open lots as LotValue objects, ordered by the date each lot was opened."""
+    
+    out = list(self.closed_lots)
+    for half_lot in self.long_half_lots:
+      out.append(half_lot.to_lot(None, 0.0, 0.0, 0.0))
       
-    for half_lot in (self.long_half_lots + self.short_half_lots):
-      insort(out, half_lot.to_lot(None, 0.0, 0.0, 0.0))
+    for half_lot in self.short_half_lots:
+      out.append(half_lot.to_lot(None, 0.0, 0.0, 0.0))
       
+    out.sort(key = (lambda lot: lot.sort_key))
     return out
+  
+  def _add_closed_lot(self, lot):
+    self.closed_lots.append(lot)
+    self.realized_pl += lot.sold_total - lot.total
 
-class HalfLot():
+class HalfLot(object):
+  __slots__ = ( 'type', 'as_of_date', 'quantity', 'price', 'total' )
+  
   def __init__(self, type, as_of_date, quantity, price, total):
     self.type = type
     self.as_of_date = as_of_date
@@ -181,10 +472,15 @@ class HalfLot():
         self.total,
       )
     
+  def to_state(self):
+    return [ self.type, self.as_of_date.toordinal(), self.quantity, self.price, self.total ]
+  
   def close(self, as_of_date, price, fees):
     return self.to_lot(as_of_date, self.quantity, price, fees)
   
-  def partial_close(self, as_of_date, quantity, price, fees):
+  def split(self, quantity):
+    """Split the given quantity (and its share of the total) off into a new half lot."""
+    
     split_lot = HalfLot(type = self.type,
         as_of_date = self.as_of_date,
         quantity = quantity,
@@ -195,12 +491,12 @@ class HalfLot():
     split_lot.total = self.total * (split_lot.quantity / self.quantity)
     self.total -= split_lot.total
     self.quantity -= quantity
-    return split_lot.close(as_of_date, price, fees)
+    return split_lot
   
   def to_lot(self, as_of_date, quantity, price, fees):
     lot = None
     if self.type == 'BUY':
-      lot = Lot(as_of_date = self.as_of_date,
+      lot = LotValue(as_of_date = self.as_of_date,
           quantity = self.quantity,
           price = self.price,
           total = self.total,
@@ -210,7 +506,7 @@ class HalfLot():
           sold_total = (quantity * price) + fees,
         )
     else:
-      lot = Lot(as_of_date = as_of_date,
+      lot = LotValue(as_of_date = as_of_date,
           quantity = quantity,
           price = price,
           total = (quantity * price) + fees,
@@ -221,14 +517,290 @@ class HalfLot():
         )
     
     return lot
+
+class LotValue(object):
+  """A matched (or still open) lot held by the LotBuilder, with the fields of a Lot row. Lots are only
+     written as Lot rows when positions are saved."""
+  
+  __slots__ = ( 'as_of_date', 'quantity', 'price', 'total', 'sold_as_of_date', 'sold_quantity', 'sold_price', 'sold_total', 'sort_key' )
+  
+  def __init__(self, as_of_date, quantity, price, total, sold_as_of_date, sold_quantity, sold_price, sold_total):
+    self.as_of_date = as_of_date
+    self.quantity = quantity
+    self.price = price
+    self.total = total
+    self.sold_as_of_date = sold_as_of_date
+    self.sold_quantity = sold_quantity
+    self.sold_price = sold_price
+    self.sold_total = sold_total
+    self.sort_key = min([ date for date in [ as_of_date, sold_as_of_date ] if date != None ]).toordinal()
+    
+  def __repr__(self):
+    return "LotValue: Bought %.4f @ %.4f on %s, Sold %.4f @ %.4f on %s" % (
+        self.quantity,
+        self.price,
+        self.as_of_date,
+        self.sold_quantity,
+        self.sold_price,
+        self.sold_as_of_date,
+      )
+    
+  def to_state(self):
+    return [
+        (self.as_of_date.toordinal() if self.as_of_date != None else None),
+        self.quantity,
+        self.price,
+        self.total,
+        (self.sold_as_of_date.toordinal() if self.sold_as_of_date != None else None),
+        self.sold_quantity,
+        self.sold_price,
+        self.sold_total,
+      ]
+
+class FifoLotPool:
+  """Open half lots of one side of a LotBuilder, relieved oldest first. Lot pools hand out the next lot to
+     relieve with peek, remove it with pop (or split part of it off), and iterate over all open lots in no
+     particular order. in_order lists them in an order that rebuilds the same pool when pushed back."""
+  
+  def __init__(self):
+    self.lots = deque()
+    
+  def __len__(self):
+    return len(self.lots)
+  
+  def __iter__(self):
+    return iter(self.lots)
+  
+  def __repr__(self):
+    return "%s: %s" % (self.__class__.__name__, list(self))
+  
+  def in_order(self):
+    return list(self.lots)
+  
+  def push(self, half_lot):
+    self.lots.append(half_lot)
+    
+  def peek(self):
+    return self.lots[0]
+  
+  def pop(self):
+    return self.lots.popleft()
+  
+  def split(self, quantity):
+    return self.peek().split(quantity)
+
+class LifoLotPool(FifoLotPool):
+  """Open half lots relieved newest first."""
+  
+  def peek(self):
+    return self.lots[-1]
+  
+  def pop(self):
+    return self.lots.pop()
+
+class CostOrderedLotPool(FifoLotPool):
+  """Open half lots relieved by price on a heap, highest first (or lowest first), oldest first between lots
+     of the same price."""
+  
+  def __init__(self, highest_first):
+    self.sign = (-1.0 if highest_first else 1.0)
+    self.sequence = count()
+    self.heap = []
+    
+  def __len__(self):
+    return len(self.heap)
+  
+  def __iter__(self):
+    return iter([ entry[2] for entry in self.heap ])
+  
+  def in_order(self):
+    return [ entry[2] for entry in sorted(self.heap) ]
+  
+  def push(self, half_lot):
+    heappush(self.heap, (self.sign * half_lot.price, self.sequence.next(), half_lot))
+    
+  def peek(self):
+    return self.heap[0][2]
+  
+  def pop(self):
+    return heappop(self.heap)[2]
+
+class AverageCostLotPool(FifoLotPool):
+  """Open half lots relieved oldest first, all carried at the average cost of the pool. Lots are repriced to
+     the current average whenever they are handed out."""
+  
+  def __init__(self):
+    FifoLotPool.__init__(self)
+    self.quantity = 0.0
+    self.total = 0.0
+    
+  def __iter__(self):
+    return iter([ self._reprice(half_lot) for half_lot in self.lots ])
+  
+  def in_order(self):
+    return list(self)
+  
+  def push(self, half_lot):
+    FifoLotPool.push(self, half_lot)
+    self.quantity += half_lot.quantity
+    self.total += half_lot.total
+    
+  def peek(self):
+    return self._reprice(FifoLotPool.peek(self))
+  
+  def pop(self):
+    half_lot = self.peek()
+    FifoLotPool.pop(self)
+    return self._relieve(half_lot)
+  
+  def split(self, quantity):
+    return self._relieve(self.peek().split(quantity))
+  
+  def _reprice(self, half_lot):
+    if self.quantity > QUANTITY_TOLERANCE:
+      half_lot.price = self.total / self.quantity
+      half_lot.total = half_lot.quantity * half_lot.price
+      
+    return half_lot
+  
+  def _relieve(self, half_lot):
+    self.quantity -= half_lot.quantity
+    self.total -= half_lot.total
+    if len(self.lots) == 0:
+      self.quantity = 0.0
+      self.total = 0.0
+      
+    return half_lot
       
 #-------------------\
 #  LOCAL FUNCTIONS  |
 #-------------------/
 
-def _refresh_positions_from_transactions(transactions):
-  if len(transactions) == 0:
-    return
+def _is_refresh_needed(portfolio, transactions):
+  return (_marked_refresh_date(portfolio) != None or _is_never_built(portfolio, transactions))
+
+def _is_never_built(portfolio, transactions):
+  return (transactions.count() > 0 and Position.objects.filter(portfolio__id__exact = portfolio.id).count() == 0)
+
+def _earliest_refresh_date(first, second):
+  return (None if first == None or second == None else min(first, second))
+
+def _queue_refresh(portfolio, from_date):
+  POSITION_REFRESH_LOCK.acquire()
+  try:
+    if POSITION_REFRESH_DATES.has_key(portfolio.id):
+      from_date = _earliest_refresh_date(POSITION_REFRESH_DATES[portfolio.id], from_date)
+      
+    POSITION_REFRESH_DATES[portfolio.id] = from_date
+    POSITION_WORKERS.submit(('positions', portfolio.id), _refresh_positions_in_background, portfolio.id)
+    
+  finally:
+    POSITION_REFRESH_LOCK.release()
+
+def _mark_refresh(portfolio, from_date):
+  # the mark is only ever written by single column updates, so saving a portfolio never overwrites it
+  marked_date = (from_date if from_date != None else EARLIEST_REFRESH_DATE)
+  cursor = connection.cursor()
+  try:
+    cursor.execute("""
+        UPDATE portfolio
+           SET positions_refresh_date = (CASE WHEN positions_refresh_date IS NULL OR positions_refresh_date > %s THEN %s ELSE positions_refresh_date END)
+         WHERE id = %s""", [ marked_date, marked_date, portfolio.id ])
+    
+  finally:
+    cursor.close()
+    
+  transaction.set_dirty()
+
+def _marked_refresh_date(portfolio):
+  cursor = connection.cursor()
+  try:
+    cursor.execute('SELECT positions_refresh_date FROM portfolio WHERE id = %s', [ portfolio.id ])
+    row = cursor.fetchone()
+    return (row[0] if row != None else None)
+  
+  finally:
+    cursor.close()
+
+def _clear_refresh_mark(portfolio, marked_date):
+  # only the mark the rebuild started from is cleared, an earlier date marked meanwhile is rebuilt next time
+  cursor = connection.cursor()
+  try:
+    cursor.execute('UPDATE portfolio SET positions_refresh_date = NULL WHERE id = %s AND positions_refresh_date = %s', [ portfolio.id, marked_date ])
+    
+  finally:
+    cursor.close()
+  
+  transaction.set_dirty()
+
+def _lock_portfolio(portfolio):
+  lock = _portfolio_lock(portfolio)
+  lock.acquire()
+  try:
+    if advisory_lock(('frano.positions.%d' % portfolio.id), POSITION_LOCK_TIMEOUT_IN_SECONDS):
+      return True
+    
+  except:
+    lock.release()
+    raise
+  
+  lock.release()
+  return False
+
+def _unlock_portfolio(portfolio):
+  try:
+    release_advisory_lock('frano.positions.%d' % portfolio.id)
+  finally:
+    _portfolio_lock(portfolio).release()
+
+def _portfolio_lock(portfolio):
+  return POSITION_LOCKS[portfolio.id % POSITION_LOCK_STRIPES]
+
+def _refresh_positions_in_background(portfolio_id):
+  
+  # a job queued while an earlier one was starting may find its request already taken
+  POSITION_REFRESH_LOCK.acquire()
+  try:
+    if not POSITION_REFRESH_DATES.has_key(portfolio_id):
+      return
+    
+    from_date = POSITION_REFRESH_DATES.pop(portfolio_id)
+    
+  finally:
+    POSITION_REFRESH_LOCK.release()
+    
+  portfolios = Portfolio.objects.filter(id = portfolio_id)
+  if portfolios.count() == 1:
+    refresh_positions(portfolios[0], force = True, from_date = from_date)
+
+def _refresh_daily_values_in_background(portfolio_id, symbols):
+  for symbol in symbols:
+    QUOTE_WORKERS.wait(('quote', symbol), POSITION_LOCK_TIMEOUT_IN_SECONDS)
+    QUOTE_WORKERS.wait(('history', symbol), POSITION_LOCK_TIMEOUT_IN_SECONDS)
+    
+  portfolios = Portfolio.objects.filter(id = portfolio_id)
+  if portfolios.count() == 1:
+    refresh_daily_values(portfolios[0])
+
+@transaction.commit_on_success
+def _refresh_positions_if_needed(portfolio, transactions, force, from_date):
+  
+  # the mark is read without locking the portfolio row, and cleared as the rebuild commits, so writers marking
+  # the portfolio meanwhile never wait for the rebuild
+  marked_date = _marked_refresh_date(portfolio)
+  if marked_date != None:
+    from_date = (_earliest_refresh_date(marked_date, from_date) if force else marked_date)
+    
+  if _is_never_built(portfolio, transactions):
+    _refresh_positions_from_transactions(portfolio, transactions)
+    
+  elif force or marked_date != None:
+    _refresh_positions_from_transactions(portfolio, transactions, from_date)
+    
+  if marked_date != None:
+    _clear_refresh_mark(portfolio, marked_date)
+
+def _refresh_positions_from_transactions(portfolio, transactions, from_date = None):
   
   # presort and bucket transactions
   transactions = sorted(transactions, key = (lambda transaction: transaction.id)) 
@@ -237,10 +809,20 @@ def _refresh_positions_from_transactions(transactions):
   transactions_by_date = dict([(date, []) for date in dates])
   for transaction in transactions:
     transactions_by_date.get(transaction.as_of_date).append(transaction)
+  
+  # checkpoints of the rebuilt window are dropped with the positions, the latest one before it is resumed from
+  checkpoint = _latest_checkpoint(portfolio, from_date)
+  _remove_positions(portfolio, from_date)
+  if len(transactions) == 0:
+    _save_daily_values(portfolio, from_date)
+    return
+  
+  # positions are only stored when they change, starting from the latest stored state before the rebuilt window
+  previous_by_symbol = dict([ (position.symbol, position) for position in latest_positions(portfolio) ])
     
   # prepare trackers
   builder_by_symbol = { }
-  cash = Position(portfolio = transactions[0].portfolio,
+  cash = Position(portfolio = portfolio,
       as_of_date = datetime.now().date(),
       symbol = CASH_SYMBOL,
       quantity = 0,
@@ -249,13 +831,20 @@ def _refresh_positions_from_transactions(transactions):
       realized_pl = 0.0
     )
   
+  if checkpoint != None and not _load_checkpoint(checkpoint, portfolio.lot_relief_method, builder_by_symbol, cash):
+    checkpoint = None
+  
   # go through days and build positions
-  lots = None
   positions = []
-  for date in dates:
+  checkpoints = []
+  for i, date in enumerate(dates):
+    if checkpoint != None and date <= checkpoint.as_of_date:
+      continue
+    
     current_transactions = transactions_by_date.get(date)
     
-    # process transactions either through cash or lot builder
+    # process transactions either through cash or lot builder, tracking the symbols they change
+    dirty_symbols = set([])
     for transaction in current_transactions:
       if transaction.type == 'DEPOSIT' or transaction.type == 'SELL':
         cash.quantity += transaction.total
@@ -270,74 +859,307 @@ def _refresh_positions_from_transactions(transactions):
       if transaction.type == 'BUY' or transaction.type == 'SELL':
         builder = builder_by_symbol.get(transaction.symbol, None)
         if builder == None:
-          builder = LotBuilder()
+          builder = LotBuilder(portfolio.lot_relief_method)
           builder_by_symbol[transaction.symbol] = builder
           
         builder.add_transaction(transaction)
+        dirty_symbols.add(transaction.symbol)
+    
+    # checkpoint the replay state on the last transaction date of every completed month
+    next_date = (dates[i + 1] if (i + 1) < len(dates) else None)
+    if (from_date == None or date >= from_date) and next_date != None and (next_date.year, next_date.month) != (date.year, date.month):
+      checkpoints.append(_build_checkpoint(portfolio, date, builder_by_symbol, cash))
+    
+    # positions before the rebuild window are already stored
+    if from_date != None and date < from_date:
+      continue
       
     # add current cash to positions.
     days_cash = _clone_position(cash, date)
     days_cash.cost_basis = days_cash.quantity
-    positions.append(days_cash)
+    if _is_position_changed(previous_by_symbol.get(CASH_SYMBOL), days_cash):
+      positions.append(days_cash)
+      previous_by_symbol[CASH_SYMBOL] = days_cash
         
-    # compose current lots into a position.
-    lots = []
-    for symbol, builder in builder_by_symbol.items():
-      position = Position(portfolio = transactions[0].portfolio, 
+    # compose the current lots of changed symbols into positions, the stored positions of the rest still hold
+    for symbol in dirty_symbols:
+      position = builder_by_symbol[symbol].compose(Position(portfolio = portfolio, 
           as_of_date = date,
           symbol = symbol, 
           quantity = 0.0, 
           cost_price = 0.0, 
           cost_basis = 0.0,
           realized_pl = 0.0,
-        )
-      
-      for lot in builder.get_lots():
-        lot.position = position
-        lots.append(lot)
-        
-        quantity = (lot.quantity - lot.sold_quantity)
-        if abs(quantity) < QUANTITY_TOLERANCE:
-          quantity = 0.0
-          
-        if abs(quantity) > QUANTITY_TOLERANCE:
-          position.cost_basis += (lot.total - lot.sold_total)
-          total = (position.quantity * position.cost_price) + (quantity * lot.price)
-          position.quantity += quantity
-          position.cost_price = (total / position.quantity if quantity <> 0.0 else 0.0)
-          
-        else:
-          position.realized_pl += lot.sold_total - lot.total
-          
-      if abs(position.quantity) < QUANTITY_TOLERANCE:
-        position.quantity = 0.0
+        ))
         
-      positions.append(position)
+      if _is_position_changed(previous_by_symbol.get(symbol), position):
+        positions.append(position)
+        previous_by_symbol[symbol] = position
     
   # save positions
-  for position in positions:
-    position.save()
-    
-  # save latest lots
-  for lot in lots:
-    if abs(lot.quantity) < QUANTITY_TOLERANCE:
-      lot.quantity = 0.0
-    
-    if abs(lot.sold_quantity) < QUANTITY_TOLERANCE:
-      lot.sold_quantity = 0.0
-    
-    lot.position = lot.position # hack to reset position_id in lot
-    lot.save()
-
-def _clone_lot(lot):
-  return Lot(as_of_date = lot.as_of_date,
-      quantity = lot.quantity,
-      price = lot.price,
-      total = lot.total,
-      sold_as_of_date = lot.sold_as_of_date,
-      sold_quantity = lot.sold_quantity,
-      sold_price = lot.sold_price,
-      sold_total = lot.sold_total
+  bulk_insert(Position._meta.db_table, 
+      [ 'portfolio_id', 'as_of_date', 'symbol', 'quantity', 'cost_price', 'cost_basis', 'realized_pl' ], 
+      [ (portfolio.id, p.as_of_date, p.symbol, p.quantity, p.cost_price, p.cost_basis, p.realized_pl) for p in positions ]
+    )
+    
+  # save current lots against the latest position of each symbol, resolving the ids of the positions just saved
+  position_id_by_symbol = dict([ (position.symbol, position.id) for position in latest_positions(portfolio) ])
+  lot_rows = []
+  for symbol, builder in builder_by_symbol.items():
+    for lot in builder.get_lots():
+      lot_rows.append((position_id_by_symbol[symbol],
+          lot.as_of_date,
+          (lot.quantity if abs(lot.quantity) >= QUANTITY_TOLERANCE else 0.0),
+          lot.price,
+          lot.total,
+          lot.sold_as_of_date,
+          (lot.sold_quantity if abs(lot.sold_quantity) >= QUANTITY_TOLERANCE else 0.0),
+          lot.sold_price,
+          lot.sold_total,
+        ))
+  
+  bulk_insert(Lot._meta.db_table, 
+      [ 'position_id', 'as_of_date', 'quantity', 'price', 'total', 'sold_as_of_date', 'sold_quantity', 'sold_price', 'sold_total' ], 
+      lot_rows
+    )
+    
+  # save checkpoints, keeping only the latest few
+  bulk_insert(PositionCheckpoint._meta.db_table, 
+      [ 'portfolio_id', 'as_of_date', 'state' ], 
+      [ (portfolio.id, checkpoint.as_of_date, checkpoint.state) for checkpoint in checkpoints ]
+    )
+    
+  stale_ids = PositionCheckpoint.objects.filter(portfolio__id__exact = portfolio.id).order_by('-as_of_date').values_list('id', flat = True)[POSITION_CHECKPOINTS_KEPT:]
+  bulk_delete(PositionCheckpoint._meta.db_table, list(stale_ids))
+  
+  # daily values are derived from positions, recompute them over the same window
+  _save_daily_values(portfolio, from_date)
+
+def _save_daily_values(portfolio, from_date):
+  values = PortfolioDailyValue.objects.filter(portfolio__id__exact = portfolio.id)
+  if from_date != None:
+    values = values.filter(as_of_date__gte = from_date)
+  
+  rows = daily_values(portfolio, from_date)
+  bulk_delete(PortfolioDailyValue._meta.db_table, list(values.values_list('id', flat = True)))
+  bulk_insert(PortfolioDailyValue._meta.db_table, 
+      [ 'portfolio_id', 'as_of_date', 'market_value', 'deposit', 'withdrawal' ],
+      [ (portfolio.id, as_of_date, market_value, deposit, withdrawal) for as_of_date, market_value, deposit, withdrawal in rows ]
+    )
+
+def _daily_values_in_sql(portfolio, from_date):
+  
+  # dates with prices for any of the portfolio's symbols, since its first position (and from_date)
+  dates_query = """
+      SELECT DISTINCT
+             DATE(H.as_of_date) as portfolio_date
+        FROM (
+               SELECT DISTINCT
+                      P.symbol
+                 FROM position P
+                WHERE P.symbol != '*CASH'
+                  AND P.portfolio_id = %(portfolio_id)s
+             ) S
+             JOIN quote Q ON (Q.symbol = S.symbol)
+             JOIN price_history H ON (H.quote_id = Q.id)
+       WHERE H.as_of_date >= (SELECT MIN(P.as_of_date) FROM position P WHERE P.portfolio_id = %(portfolio_id)s)
+         AND H.as_of_date >= %(from_date)s"""
+  
+  # positions are only stored when they change, so each symbol is valued from its latest position as of each date
+  query = """
+      SELECT D.portfolio_date,
+             SUM(P.quantity * ((CASE WHEN P.symbol = '*CASH' OR Q.cash_equivalent = '1' THEN 1.0 ELSE H.price END))) as market_value,
+             D.deposit,
+             D.withdrawal
+        FROM (
+                 SELECT D.portfolio_date,
+                        SUM(CASE WHEN T.type = 'DEPOSIT' THEN T.total ELSE 0 END) as deposit,
+                        SUM(CASE WHEN T.type = 'WITHDRAW' THEN T.total ELSE 0 END) as withdrawal
+                   FROM (""" + dates_query + """
+                        ) D
+                        LEFT JOIN transaction T ON (T.portfolio_id = %(portfolio_id)s AND T.type IN ('DEPOSIT', 'WITHDRAW') AND T.as_of_date = D.portfolio_date)
+               GROUP BY D.portfolio_date
+             ) D
+             JOIN
+             (
+                 SELECT D.portfolio_date,
+                        P.symbol,
+                        MAX(P.as_of_date) as position_date
+                   FROM (""" + dates_query + """
+                        ) D
+                        JOIN position P ON (P.portfolio_id = %(portfolio_id)s AND P.as_of_date <= D.portfolio_date)
+               GROUP BY D.portfolio_date,
+                        P.symbol
+             ) S ON (S.portfolio_date = D.portfolio_date)
+             JOIN position P ON (P.portfolio_id = %(portfolio_id)s AND P.symbol = S.symbol AND P.as_of_date = S.position_date)
+             LEFT JOIN quote Q ON (Q.symbol = P.symbol)
+             LEFT JOIN price_history H ON (H.quote_id = Q.id AND H.as_of_date = D.portfolio_date)
+       WHERE P.quantity <> 0
+    GROUP BY D.portfolio_date,
+             D.deposit,
+             D.withdrawal
+    ORDER BY D.portfolio_date"""
+  
+  cursor = connection.cursor()
+  try:
+    cursor.execute(query, { 'portfolio_id' : portfolio.id, 'from_date' : (from_date if from_date != None else date.min) })
+    return [ (row[0], float(row[1] or 0.0), float(row[2]), float(row[3])) for row in cursor.fetchall() ]
+  
+  finally:
+    cursor.close()
+
+def _daily_values_in_python(portfolio, from_date):
+  
+  # positions are only stored when they change, as parallel arrays of date ordinals and quantities per symbol
+  changes_by_symbol = { }
+  for symbol, as_of_date, quantity in Position.objects.filter(portfolio__id__exact = portfolio.id).order_by('symbol', 'as_of_date').values_list('symbol', 'as_of_date', 'quantity'):
+    changes = changes_by_symbol.setdefault(symbol, ([], []))
+    changes[0].append(as_of_date.toordinal())
+    changes[1].append(quantity)
+  
+  if len(changes_by_symbol) == 0:
+    return []
+  
+  quotes = list(Quote.objects.filter(symbol__in = [ symbol for symbol in changes_by_symbol.keys() if symbol != CASH_SYMBOL ]))
+  quote_by_symbol = dict([ (quote.symbol, quote) for quote in quotes ])
+  series_by_id = price_series_for_quotes(quotes)
+  
+  # dates with prices for any of the portfolio's symbols, since its first position (and from_date)
+  start = min([ changes[0][0] for changes in changes_by_symbol.values() ])
+  if from_date != None:
+    start = max(start, from_date.toordinal())
+    
+  dates = numpy.unique(numpy.concatenate([ numpy.zeros(0, dtype = int) ] + [ numpy.array(series.dates, dtype = int) for series in series_by_id.values() ]))
+  dates = dates[dates >= start]
+  
+  market_value = numpy.zeros(len(dates))
+  held = numpy.zeros(len(dates), dtype = bool)
+  for symbol, (change_dates, quantities) in changes_by_symbol.items():
+    index = numpy.searchsorted(numpy.array(change_dates, dtype = int), dates, side = 'right') - 1
+    quantity = numpy.where(index >= 0, numpy.array(quantities, dtype = float)[numpy.maximum(index, 0)], 0.0)
+    held |= (quantity != 0)
+    
+    quote = quote_by_symbol.get(symbol)
+    if symbol == CASH_SYMBOL or (quote != None and quote.cash_equivalent):
+      market_value += quantity
+      
+    elif quote != None:
+      series = series_by_id[quote.id]
+      market_value += quantity * _values_on_dates(dates, numpy.array(series.dates, dtype = int), numpy.array(series.prices, dtype = float))
+  
+  flows = list(Transaction.objects.filter(portfolio__id__exact = portfolio.id, type__in = [ 'DEPOSIT', 'WITHDRAW' ]).values_list('as_of_date', 'type', 'total'))
+  flow_dates = numpy.array([ as_of_date.toordinal() for as_of_date, type, total in flows ], dtype = int)
+  deposits = _values_on_dates(dates, flow_dates, numpy.array([ (total if type == 'DEPOSIT' else 0.0) for as_of_date, type, total in flows ], dtype = float))
+  withdrawals = _values_on_dates(dates, flow_dates, numpy.array([ (total if type == 'WITHDRAW' else 0.0) for as_of_date, type, total in flows ], dtype = float))
+  
+  # like the SQL engine, dates without any open position are left out
+  return [ (date.fromordinal(int(dates[i])), float(market_value[i]), float(deposits[i]), float(withdrawals[i])) for i in numpy.flatnonzero(held) ]
+
+def _values_on_dates(dates, value_dates, values):
+  """Sum of the values falling on each of the given (sorted) dates, values on other dates are dropped."""
+  
+  if len(dates) == 0 or len(value_dates) == 0:
+    return numpy.zeros(len(dates))
+  
+  index = numpy.minimum(numpy.searchsorted(dates, value_dates), len(dates) - 1)
+  matched = (dates[index] == value_dates)
+  return numpy.bincount(index[matched], weights = values[matched], minlength = len(dates))
+
+def _new_lot_pool(relief_method, short):
+  if relief_method == 'LIFO':
+    return LifoLotPool()
+  
+  elif relief_method == 'HIFO':
+    # covering the short sold at the lowest price first is the tax optimized order for shorts
+    return CostOrderedLotPool(not short)
+  
+  elif relief_method == 'AVERAGE':
+    return AverageCostLotPool()
+  
+  else:
+    return FifoLotPool()
+
+def _cumulative_by_cell(cells, changes, shape):
+  size = 1
+  for dimension in shape:
+    size *= dimension
+    
+  totals = numpy.zeros(size)
+  if len(cells) > 0:
+    totals += numpy.bincount(cells, weights = changes, minlength = size)
+    
+  return totals.reshape(shape).cumsum(axis = 0)
+
+def _is_position_changed(previous, position):
+  if previous == None:
+    return True
+  
+  return (abs(position.quantity - previous.quantity) > QUANTITY_TOLERANCE
+      or abs(position.cost_price - previous.cost_price) > QUANTITY_TOLERANCE
+      or abs(position.cost_basis - previous.cost_basis) > QUANTITY_TOLERANCE
+      or abs(position.realized_pl - previous.realized_pl) > QUANTITY_TOLERANCE)
+
+def _remove_positions(portfolio, from_date):
+  # only the latest positions have lots, and those are always rebuilt
+  lots = Lot.objects.filter(position__portfolio__id__exact = portfolio.id)
+  bulk_delete(Lot._meta.db_table, list(lots.values_list('id', flat = True)))
+  
+  positions = Position.objects.filter(portfolio__id__exact = portfolio.id)
+  checkpoints = PositionCheckpoint.objects.filter(portfolio__id__exact = portfolio.id)
+  if from_date != None:
+    positions = positions.filter(as_of_date__gte = from_date)
+    checkpoints = checkpoints.filter(as_of_date__gte = from_date)
+    
+  bulk_delete(Position._meta.db_table, list(positions.values_list('id', flat = True)))
+  bulk_delete(PositionCheckpoint._meta.db_table, list(checkpoints.values_list('id', flat = True)))
+
+def _latest_checkpoint(portfolio, from_date):
+  if from_date == None:
+    return None
+  
+  checkpoints = PositionCheckpoint.objects.filter(portfolio__id__exact = portfolio.id, as_of_date__lt = from_date).order_by('-as_of_date')[0:1]
+  return (checkpoints[0] if len(checkpoints) > 0 else None)
+
+def _build_checkpoint(portfolio, as_of_date, builder_by_symbol, cash):
+  state = {
+      'relief_method' : portfolio.lot_relief_method,
+      'cash' : [ cash.quantity, cash.realized_pl ],
+      'builders' : dict([ (symbol, builder.to_state()) for symbol, builder in builder_by_symbol.items() ]),
+    }
+  
+  return PositionCheckpoint(portfolio = portfolio, as_of_date = as_of_date, state = json.dumps(state))
+
+def _load_checkpoint(checkpoint, relief_method, builder_by_symbol, cash):
+  # checkpoints taken under another lot relief method can not be resumed from
+  state = json.loads(checkpoint.state)
+  if state.get('relief_method', 'FIFO') != relief_method:
+    return False
+  
+  cash.quantity, cash.realized_pl = state['cash']
+  for symbol, builder_state in state['builders'].items():
+    builder_by_symbol[symbol] = LotBuilder(relief_method).load_state(builder_state)
+    
+  return True
+
+def _half_lot_from_state(state):
+  type, as_of_date, quantity, price, total = state
+  return HalfLot(type = type,
+      as_of_date = date.fromordinal(as_of_date),
+      quantity = quantity,
+      price = price,
+      total = total,
+    )
+
+def _lot_value_from_state(state):
+  as_of_date, quantity, price, total, sold_as_of_date, sold_quantity, sold_price, sold_total = state
+  return LotValue(as_of_date = (date.fromordinal(as_of_date) if as_of_date != None else None),
+      quantity = quantity,
+      price = price,
+      total = total,
+      sold_as_of_date = (date.fromordinal(sold_as_of_date) if sold_as_of_date != None else None),
+      sold_quantity = sold_quantity,
+      sold_price = sold_price,
+      sold_total = sold_total,
     )
 
 def _clone_position(position, new_as_of_date = None):
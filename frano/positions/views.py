@@ -4,29 +4,52 @@
 
 from datetime import datetime
 from datetime import timedelta
+from threading import Lock
+from time import time
 
-from django.db import connection
-from django.db import transaction
+from django.db.models import Count
+from django.db.models import Max
 
 from main.decorators import portfolio_manipulation_decorator
 from main.decorators import read_only_decorator
 from main.models import Portfolio
 from main.view_utils import render_page
+from models import Lot
+from models import PortfolioDailyValue
+from models import daily_holdings
 from models import decorate_position_with_prices
 from models import latest_positions
+from models import refresh_daily_values_in_background
 from models import refresh_positions
 from quotes.models import CASH_SYMBOL
-from quotes.models import quote_by_symbol
+from quotes.models import benchmark_series
 from quotes.models import quotes_by_symbols
-from quotes.models import previous_close_price
+from quotes.models import previous_close_prices
+from settings import PERFORMANCE_BENCHMARK_SYMBOLS
 from transactions.models import Transaction
 
 #-------------\
 #  CONSTANTS  |
 #-------------/
 
-DAYS_IN_PERFORMANCE_HISTORY = 90
-PERFORMANCE_BENCHMARK_SYMBOL = 'ACWI'
+# selectable performance history ranges as (code, days of history), None for since inception
+PERFORMANCE_RANGES = (
+    ( '3M', 90 ),
+    ( '1Y', 365 ),
+    ( '5Y', 365 * 5 ),
+    ( 'ALL', None ),
+  )
+
+DEFAULT_PERFORMANCE_RANGE = '3M'
+
+# longer ranges are downsampled to at most this many points before being plotted
+PERFORMANCE_HISTORY_MAX_POINTS = 250
+
+# (portfolio id, range) to (version, performance history, computed time) cache, the version changes with the stored daily 
+# values, the benchmarks' price history and the current date. The size bounds how many histories are kept
+PERFORMANCE_HISTORY_CACHE = { }
+PERFORMANCE_HISTORY_CACHE_LOCK = Lock()
+PERFORMANCE_HISTORY_CACHE_SIZE = 1000
 
 #---------\
 #  VIEWS  |
@@ -42,7 +65,17 @@ def positions(request, portfolio, is_sample, read_only):
   _decorate_positions_for_display(positions, request.GET.get("showClosedPositions", False))
   _decorate_positions_with_lots(positions)
   summary = _get_summary(positions, transactions)
-  performance_history = _get_performance_history(portfolio, DAYS_IN_PERFORMANCE_HISTORY)
+  
+  # values stored while quotes were still being retrieved are recomputed once they are in
+  pending_symbols = [ position.symbol for position in positions if position.pending ]
+  if len(pending_symbols) > 0:
+    refresh_daily_values_in_background(portfolio, pending_symbols)
+  
+  performance_range = request.GET.get('performanceRange', DEFAULT_PERFORMANCE_RANGE)
+  if not dict(PERFORMANCE_RANGES).has_key(performance_range):
+    performance_range = DEFAULT_PERFORMANCE_RANGE
+    
+  performance_history = _get_cached_performance_history(portfolio, performance_range)
   
   context = {
       'read_only' : read_only, 
@@ -51,7 +84,9 @@ def positions(request, portfolio, is_sample, read_only):
       'summary' : summary, 
       'current_tab' : 'positions',
       'performance_history' : performance_history, 
-      'benchmark_symbol' : PERFORMANCE_BENCHMARK_SYMBOL,
+      'performance_range' : performance_range,
+      'performance_ranges' : [ code for code, days in PERFORMANCE_RANGES ],
+      'benchmark_symbols' : PERFORMANCE_BENCHMARK_SYMBOLS,
     }
   
   return render_page('positions.html', request, portfolio = portfolio, extra_dictionary = context)
@@ -62,9 +97,16 @@ def read_only_positions(request, portfolio):
 
 @portfolio_manipulation_decorator
 def allocation(request, portfolio, is_sample, read_only):
-  refresh_positions(portfolio)
   
-  positions = latest_positions(portfolio)
+  # allocation needs no lots, use the array engine when it is available
+  holdings = daily_holdings(portfolio)
+  if holdings != None:
+    positions = holdings.positions(portfolio)
+    
+  else:
+    refresh_positions(portfolio)
+    positions = latest_positions(portfolio)
+    
   _decorate_positions_for_display(positions, False)
   
   context = { 
@@ -135,15 +177,17 @@ def read_only_income(request, portfolio):
 def _decorate_positions_for_display(positions, showClosedPositions):
   
   symbols = [ position.symbol for position in positions ] + [ CASH_SYMBOL ]
-  quotes = dict((quote.symbol, quote) for quote in quotes_by_symbols(symbols))
+  quotes = dict((quote.symbol, quote) for quote in quotes_by_symbols(symbols, background = True))
+  previous_prices = previous_close_prices(quotes.values())
   as_of_date = min([quote.last_trade.date() for symbol, quote in quotes.items()])
   
   total_market_value = 0
   for position in positions:
     price = (1.0 if position.symbol == CASH_SYMBOL else quotes[position.symbol].price)
-    previous_price = (1.0 if position.symbol == CASH_SYMBOL else previous_close_price(quotes[position.symbol]))
+    previous_price = (1.0 if position.symbol == CASH_SYMBOL else previous_prices[position.symbol])
     
     decorate_position_with_prices(position, price, previous_price)
+    position.pending = quotes[position.symbol].pending
     position.show = (showClosedPositions or abs(position.quantity) > 0.01 or position.symbol == CASH_SYMBOL)
     
     total_market_value += position.market_value
@@ -153,12 +197,19 @@ def _decorate_positions_for_display(positions, showClosedPositions):
     position.effective_as_of_date = as_of_date
 
 def _decorate_positions_with_lots(positions):
+  
+  # all lots of the positions are loaded with a single query, then grouped by position
+  lots_by_position = dict([ (position.id, []) for position in positions ])
+  for lot in Lot.objects.filter(position__id__in = lots_by_position.keys()).order_by('position', '-as_of_date'):
+    lots_by_position[lot.position_id].append(lot)
+  
+  today = datetime.now().date()
   for position in positions:
-    lots = []
-    for lot in position.lot_set.order_by('-as_of_date'):
+    lots = lots_by_position.get(position.id, [])
+    for lot in lots:
       total = max(lot.total, lot.sold_total)
       
-      days_open = (datetime.now().date() - (lot.as_of_date if lot.as_of_date != None else lot.sold_as_of_date)).days
+      lot.days_open = (today - (lot.as_of_date if lot.as_of_date != None else lot.sold_as_of_date)).days
       if abs(lot.quantity - lot.sold_quantity) < 0.0001:
         lot.status = 'Closed'
         lot.pl = lot.sold_total - lot.total
@@ -167,7 +218,6 @@ def _decorate_positions_with_lots(positions):
         lot.pl = ((lot.quantity - lot.sold_quantity) * position.price) - (lot.total - lot.sold_total)
       
       lot.pl_percent = (((lot.pl / total) * 100) if total <> 0.0 else 0)
-      lots.append(lot)
     
     position.lots = lots
 
@@ -194,101 +244,62 @@ def _get_summary(positions, transactions):
   
   return Summary(as_of_date, start_date, market_value, cost_basis, risk_capital, realized_pl, previous_market_value)
 
-def _get_performance_history(portfolio, days):
-  query = """
-      SELECT D.portfolio_date,
-             D.deposit,
-             D.withdrawal,
-             SUM(P.quantity * ((CASE WHEN P.symbol = '*CASH' OR Q.cash_equivalent = '1' THEN 1.0 ELSE H.price END))) as market_value
-        FROM position P
-             JOIN
-             (
-                 SELECT D.portfolio_id,
-                        D.portfolio_date,
-                        D.position_date,
-                        SUM(CASE WHEN T.type = 'DEPOSIT' THEN T.total ELSE 0 END) as deposit,
-                        SUM(CASE WHEN T.type = 'WITHDRAW' THEN T.total ELSE 0 END) as withdrawal
-                   FROM (
-                            SELECT P.portfolio_id,
-                                   D.portfolio_date,
-                                   MAX(P.as_of_date) as position_date
-                              FROM (
-                                     SELECT DISTINCT
-                                            D.portfolio_id,
-                                            DATE(H.as_of_date) as portfolio_date
-                                       FROM (
-                                              SELECT DISTINCT
-                                                     P.portfolio_id,
-                                                     P.symbol
-                                                FROM position P
-                                               WHERE P.symbol != '*CASH'
-                                                 AND P.portfolio_id = %(portfolio_id)s
-                                            ) S
-                                            JOIN quote Q ON (Q.symbol = S.symbol)
-                                            JOIN price_history H ON (H.quote_id = Q.id)
-                                            JOIN
-                                            (
-                                                SELECT P.portfolio_id,
-                                                       MIN(as_of_date) as start_date
-                                                  FROM position P
-                                                 WHERE P.portfolio_id = %(portfolio_id)s
-                                              GROUP BY P.portfolio_id
-                                            ) D ON (D.portfolio_id = S.portfolio_id AND H.as_of_date >= D.start_date)
-                                      WHERE DATEDIFF(NOW(), H.as_of_date) < %(days)s
-                                   ) D
-                                   JOIN 
-                                   (
-                                     SELECT DISTINCT 
-                                            P.portfolio_id,
-                                            P.as_of_date
-                                       FROM position P
-                                      WHERE P.portfolio_id = %(portfolio_id)s
-                                   )  P ON (P.portfolio_id = D.portfolio_id AND P.as_of_date <= D.portfolio_date)
-                          GROUP BY D.portfolio_id,
-                                   D.portfolio_date
-                        ) D
-                        LEFT JOIN
-                        (
-                          SELECT T.portfolio_id,
-                                 T.as_of_date,
-                                 T.type,
-                                 T.total
-                            FROM transaction T
-                           WHERE T.type IN ('DEPOSIT', 'WITHDRAW')
-                             AND T.portfolio_id = %(portfolio_id)s
-                        ) T ON (T.portfolio_id = D.portfolio_id AND T.as_of_date = D.portfolio_date)
-               GROUP BY D.portfolio_id,
-                        D.portfolio_date
-             ) D ON (P.portfolio_id = D.portfolio_id AND P.as_of_date = D.position_date)
-             LEFT JOIN quote Q ON (Q.symbol = P.symbol)
-             LEFT JOIN price_history H ON (H.quote_id = Q.id AND H.as_of_date = D.portfolio_date)
-       WHERE P.quantity <> 0
-         AND P.portfolio_id = %(portfolio_id)s
-    GROUP BY D.portfolio_date
-    ORDER BY D.portfolio_date"""
+def _get_cached_performance_history(portfolio, performance_range):
+  today = datetime.now().date()
+  days = dict(PERFORMANCE_RANGES)[performance_range]
+  start_date = ((today - timedelta(days = days)) if days != None else None)
+  values = PortfolioDailyValue.objects.filter(portfolio__id__exact = portfolio.id)
+  benchmarks = benchmark_series(PERFORMANCE_BENCHMARK_SYMBOLS, start_date)
+  
+  # benchmarks without stored price history are retrieved by the background workers, off the request path
+  unknown_symbols = [ series.symbol for series in benchmarks if series.history_date == None ]
+  if len(unknown_symbols) > 0:
+    quotes_by_symbols(unknown_symbols, background = True)
   
-  cursor = connection.cursor()
-  cursor.execute(query, { 'days' : days, 'portfolio_id' : portfolio.id })
+  # rebuilds delete and re-insert the stored values, so their count and latest id change with every rebuild
+  stats = values.aggregate(Count('id'), Max('id'))
+  version = (today, stats['id__count'], stats['id__max'], tuple([ series.history_date for series in benchmarks ]))
+  key = (portfolio.id, performance_range)
   
-  benchmark_quote = quote_by_symbol(PERFORMANCE_BENCHMARK_SYMBOL)
-  cutoff_date = datetime.now().date() - timedelta(days = DAYS_IN_PERFORMANCE_HISTORY)
-  benchmark_price = {}
-  for history in benchmark_quote.pricehistory_set.filter(as_of_date__gte = cutoff_date).order_by('as_of_date'):
-    benchmark_price[history.as_of_date.date()] = history.price
+  PERFORMANCE_HISTORY_CACHE_LOCK.acquire()
+  try:
+    cached = PERFORMANCE_HISTORY_CACHE.get(key)
+    if cached != None and cached[0] == version:
+      return cached[1]
     
+  finally:
+    PERFORMANCE_HISTORY_CACHE_LOCK.release()
+  
+  if start_date != None:
+    values = values.filter(as_of_date__gt = start_date)
+    
+  history = _downsample(_get_performance_history(values, benchmarks), PERFORMANCE_HISTORY_MAX_POINTS)
+  
+  PERFORMANCE_HISTORY_CACHE_LOCK.acquire()
+  try:
+    PERFORMANCE_HISTORY_CACHE[key] = (version, history, time())
+    overflow = len(PERFORMANCE_HISTORY_CACHE) - PERFORMANCE_HISTORY_CACHE_SIZE
+    if overflow > 0:
+      oldest = sorted(PERFORMANCE_HISTORY_CACHE.items(), key = (lambda item: item[1][2]))[0:overflow]
+      for stale_key, entry in oldest:
+        del(PERFORMANCE_HISTORY_CACHE[stale_key])
+      
+  finally:
+    PERFORMANCE_HISTORY_CACHE_LOCK.release()
+    
+  return history
+
+def _get_performance_history(values, benchmarks):
   shares = None
   last_price = None
-  first_benchmark = None
+  first_benchmarks = None
   out = []
-  for row in cursor.fetchall():
-    as_of_date = row[0]
-    deposit = float(row[1])
-    withdraw = float(row[2])
-    market_value = float(row[3])
+  for as_of_date, deposit, withdraw, market_value in values.order_by('as_of_date').values_list('as_of_date', 'deposit', 'withdrawal', 'market_value'):
     
-    benchmark = benchmark_price.get(as_of_date, 0.0)
-    if first_benchmark == None:
-      first_benchmark = benchmark
+    # every benchmark is measured in the same pass, relative to its price on the first date
+    benchmark_prices = [ series.price_on(as_of_date) for series in benchmarks ]
+    if first_benchmarks == None:
+      first_benchmarks = benchmark_prices
     
     performance = 0
     if shares == None:
@@ -300,10 +311,41 @@ def _get_performance_history(portfolio, days):
       performance = (((market_value / shares) - 1) if shares <> 0 else 0) 
     
     last_price = ((market_value / shares) if shares <> 0 else 1.0)
-    benchmark_performance = (((benchmark / first_benchmark) - 1) if first_benchmark <> 0 else 0)
-    out.append(PerformanceHistory(as_of_date, performance, benchmark_performance))
+    benchmark_performances = [ (((price / first) - 1) if first <> 0 else 0) for price, first in zip(benchmark_prices, first_benchmarks) ]
+    out.append(PerformanceHistory(as_of_date, performance, benchmark_performances))
+    
+  return out
+
+def _downsample(history, points):
+  """Largest triangle three buckets: keeps the first and last entries and, from each bucket of entries in 
+     between, the one forming the largest triangle with the entry kept before it and the average of the next
+     bucket, which preserves the visual shape of the performance line."""
+  
+  if points < 3 or len(history) <= points:
+    return history
+  
+  bucket_size = float(len(history) - 2) / (points - 2)
+  out = [ history[0] ]
+  kept = 0
+  for i in range(points - 2):
+    start = int(i * bucket_size) + 1
+    end = int((i + 1) * bucket_size) + 1
+    next_end = min(int((i + 2) * bucket_size) + 1, len(history))
+    next_x = (end + next_end - 1) / 2.0
+    next_y = sum([ entry.percent for entry in history[end:next_end] ]) / (next_end - end)
+    
+    best = start
+    best_area = -1
+    for j in range(start, end):
+      area = abs(((kept - next_x) * (history[j].percent - history[kept].percent)) - ((kept - j) * (next_y - history[kept].percent)))
+      if area > best_area:
+        best = j
+        best_area = area
+    
+    out.append(history[best])
+    kept = best
     
-  cursor.close()
+  out.append(history[-1])
   return out
 
 #-----------------\
@@ -328,10 +370,10 @@ class Summary:
     self.risk_capital_pl_percent = ((self.risk_capital_pl / risk_capital) * 100) if risk_capital != 0 else 0
     
 class PerformanceHistory:
-  def __init__(self, as_of_date, percent, benchmark_percent):
+  def __init__(self, as_of_date, percent, benchmark_percents):
     self.as_of_date = as_of_date
     self.percent = percent
-    self.benchmark_percent = benchmark_percent
+    self.benchmark_percents = benchmark_percents
 
 class IncomeSummary:
   def __init__(self, symbol, market_value, cost_basis, unrealized_pl, unrealized_pl_percent, realized_pl, show):
@@ -2,15 +2,29 @@
 # Licensed under the MIT license
 # see LICENSE file for copying permission.
 
-import json
-
+from array import array
+from bisect import bisect_right
 from datetime import date
 from datetime import datetime
 from datetime import timedelta
-from urllib import quote_plus
-from urllib import urlopen
+from Queue import Empty
+from Queue import Queue
+from threading import Lock
+from threading import Thread
+from time import sleep
+from time import time
 
+from django.core.cache import get_cache
 from django.db import models
+from django.db import transaction
+
+from main.db_utils import bulk_delete
+from main.db_utils import bulk_insert
+from main.db_utils import bulk_update
+from main.workers import WorkerPool
+from providers import ProviderUnavailableError
+from providers import get_quote_provider
+from settings import PERFORMANCE_BENCHMARK_CACHE_BACKEND
 
 #-------------\
 #  CONSTANTS  |
@@ -19,6 +33,46 @@ from django.db import models
 CASH_SYMBOL = '*CASH'
 PRICE_HISTORY_LIMIT_IN_DAYS = 365 * 10
 
+# incremental price history refreshes re-request this many days before the latest stored row, 
+# to pick up corrections to recent adjusted closes
+PRICE_HISTORY_OVERLAP_IN_DAYS = 7
+
+# quote retrieval is split into chunks of symbols, fetched in parallel by a bounded set of threads
+QUOTE_FETCH_CHUNK_SIZE = 50
+QUOTE_FETCH_THREADS = 8
+QUOTE_FETCH_RETRIES = 2
+QUOTE_FETCH_RETRY_DELAY_IN_SECONDS = 1
+
+# unknown or unpriced symbols seen on the request path are retrieved by a pool of background workers
+QUOTE_BACKGROUND_THREADS = 4
+QUOTE_WORKERS = WorkerPool('quotes', QUOTE_BACKGROUND_THREADS)
+
+# symbols that fail to retrieve (unknown, delisted or without history) are not retried until a backoff 
+# passes, the backoff doubling with every consecutive failure up to the maximum
+FAILED_SYMBOL_BACKOFF_IN_SECONDS = 5 * 60
+FAILED_SYMBOL_MAX_BACKOFF_IN_SECONDS = 24 * 60 * 60
+
+# symbol to (consecutive failures, retry after time) cache of failed symbols
+FAILED_SYMBOLS = { }
+FAILED_SYMBOLS_LOCK = Lock()
+
+# price history series are cached in memory per quote and reloaded when the quote's history date moves,
+# the timeout bounds how long a series can be served without a fresh quote, the size bounds how many are kept
+PRICE_SERIES_CACHE_TIMEOUT_IN_SECONDS = 15 * 60
+PRICE_SERIES_CACHE_SIZE = 1000
+
+# quote id to PriceSeries cache, guarded by a lock as requests are served by multiple threads
+PRICE_SERIES_CACHE = { }
+PRICE_SERIES_CACHE_LOCK = Lock()
+
+# benchmark price series are the same for every portfolio, they are cached per (symbol, start date) and reloaded
+# when the quote's history date moves. The shared cache, if configured, holds them across processes
+BENCHMARK_SERIES_CACHE = { }
+BENCHMARK_SERIES_CACHE_LOCK = Lock()
+BENCHMARK_SERIES_CACHE_SIZE = 100
+BENCHMARK_SERIES_SHARED_CACHE = (get_cache(PERFORMANCE_BENCHMARK_CACHE_BACKEND) if PERFORMANCE_BENCHMARK_CACHE_BACKEND != None else None)
+BENCHMARK_SERIES_SHARED_TIMEOUT_IN_SECONDS = 24 * 60 * 60
+
 #----------\
 #  MODELS  |
 #----------/
@@ -29,6 +83,7 @@ class Quote(models.Model):
   price = models.FloatField()
   last_trade = models.DateTimeField()
   cash_equivalent = models.BooleanField()
+  history_date = models.DateTimeField(null = True, db_index = True)
   
   class Meta:
     db_table = 'quote'
@@ -58,21 +113,147 @@ def price_as_of(quote, as_of):
   if quote.cash_equivalent or quote.last_trade.date() == as_of:
     return quote.price
   else:
-    candidates = quote.pricehistory_set.filter(as_of_date__lte = as_of.strftime('%Y-%m-%d')).order_by('-as_of_date')[0:1]
-    return (candidates[0].price if candidates.count() > 0 else 0)
+    return price_series(quote).price_as_of(as_of)
   
 def previous_close_price(quote):
   """Get the previous close price for a quote."""
   
   return price_as_of(quote, quote.last_trade.date() - timedelta(days = 1))
 
+def previous_close_prices(quotes):
+  """Get the previous close prices for a list of quotes as a map of symbol to price, loading all 
+     uncached price history with a single query."""
+  
+  series_by_id = price_series_for_quotes([ quote for quote in quotes if not quote.cash_equivalent ])
+  
+  out = { }
+  for quote in quotes:
+    if quote.cash_equivalent:
+      out[quote.symbol] = quote.price
+    else:
+      out[quote.symbol] = series_by_id[quote.id].price_as_of(quote.last_trade.date() - timedelta(days = 1))
+    
+  return out
+
+def price_series(quote):
+  """Get the price history series of a quote, loading it into the in-memory cache if needed."""
+  
+  return price_series_for_quotes([ quote ])[quote.id]
+
+def price_series_for_quotes(quotes):
+  """Get the price history series of several quotes as a map of quote id to series, loading all uncached
+     series with a single query."""
+  
+  now = time()
+  out = { }
+  
+  PRICE_SERIES_CACHE_LOCK.acquire()
+  try:
+    for quote in quotes:
+      series = PRICE_SERIES_CACHE.get(quote.id)
+      if series != None and series.history_date == quote.history_date and not series.is_expired(now):
+        out[quote.id] = series
+  finally:
+    PRICE_SERIES_CACHE_LOCK.release()
+  
+  # load all missing series with a single query, as parallel arrays of date ordinals and prices
+  missing_ids = set([ quote.id for quote in quotes if not out.has_key(quote.id) ])
+  if len(missing_ids) > 0:
+    loaded = dict([ (quote.id, PriceSeries(array('l'), array('d'), quote.history_date)) for quote in quotes if quote.id in missing_ids ])
+    if None in missing_ids:
+      missing_ids.remove(None)
+      
+    rows = PriceHistory.objects.filter(quote__id__in = list(missing_ids)).order_by('quote', 'as_of_date').values_list('quote', 'as_of_date', 'price')
+    for quote_id, as_of_date, price in rows:
+      series = loaded[quote_id]
+      series.dates.append(as_of_date.toordinal())
+      series.prices.append(price)
+    
+    PRICE_SERIES_CACHE_LOCK.acquire()
+    try:
+      for id, series in loaded.items():
+        if id != None:
+          PRICE_SERIES_CACHE[id] = series
+        
+      _trim_price_series_cache()
+    finally:
+      PRICE_SERIES_CACHE_LOCK.release()
+    
+    out.update(loaded)
+    
+  return out
+
+def invalidate_price_series(quote):
+  """Drop the cached price history series of a quote, forcing a reload on next use."""
+  
+  PRICE_SERIES_CACHE_LOCK.acquire()
+  try:
+    PRICE_SERIES_CACHE.pop(quote.id, None)
+  finally:
+    PRICE_SERIES_CACHE_LOCK.release()
+
+def benchmark_series(symbols, start_date = None):
+  """Get the price series of the given benchmark symbols from the given date (or over their whole history), as
+     BenchmarkSeries in the order of the symbols, loading all uncached series with a single query. Only stored 
+     quotes are used, symbols without a quote get an empty series and are never retrieved."""
+  
+  quotes = Quote.objects.filter(symbol__in = symbols).values_list('symbol', 'id', 'history_date')
+  quote_by_symbol = dict([ (symbol, (id, history_date)) for symbol, id, history_date in quotes ])
+  found = { }
+  
+  BENCHMARK_SERIES_CACHE_LOCK.acquire()
+  try:
+    for symbol in symbols:
+      series = BENCHMARK_SERIES_CACHE.get((symbol, start_date))
+      if series != None and series.history_date == quote_by_symbol.get(symbol, (None, None))[1]:
+        found[symbol] = series
+  finally:
+    BENCHMARK_SERIES_CACHE_LOCK.release()
+  
+  missing = [ symbol for symbol in symbols if not found.has_key(symbol) ]
+  if len(missing) > 0:
+    loaded = dict([ (symbol, BenchmarkSeries(symbol, quote_by_symbol.get(symbol, (None, None))[1], { })) for symbol in missing ])
+    shared_keys = dict([ (_shared_benchmark_key(series, start_date), series) for series in loaded.values() ])
+    if BENCHMARK_SERIES_SHARED_CACHE != None:
+      for key, prices in BENCHMARK_SERIES_SHARED_CACHE.get_many(shared_keys.keys()).items():
+        shared_keys.pop(key).prices = prices
+    
+    # series not found in the shared cache are loaded together and shared for other processes
+    series_by_id = dict([ (quote_by_symbol[series.symbol][0], series) for series in shared_keys.values() if quote_by_symbol.has_key(series.symbol) ])
+    if len(series_by_id) > 0:
+      rows = PriceHistory.objects.filter(quote__id__in = series_by_id.keys())
+      if start_date != None:
+        rows = rows.filter(as_of_date__gte = start_date)
+        
+      for quote_id, as_of_date, price in rows.values_list('quote', 'as_of_date', 'price'):
+        series_by_id[quote_id].prices[as_of_date.date()] = price
+        
+      if BENCHMARK_SERIES_SHARED_CACHE != None:
+        for series in series_by_id.values():
+          BENCHMARK_SERIES_SHARED_CACHE.set(_shared_benchmark_key(series, start_date), series.prices, BENCHMARK_SERIES_SHARED_TIMEOUT_IN_SECONDS)
+    
+    BENCHMARK_SERIES_CACHE_LOCK.acquire()
+    try:
+      for symbol, series in loaded.items():
+        BENCHMARK_SERIES_CACHE[(symbol, start_date)] = series
+        
+      _trim_benchmark_series_cache()
+    finally:
+      BENCHMARK_SERIES_CACHE_LOCK.release()
+    
+    found.update(loaded)
+    
+  return [ found[symbol] for symbol in symbols ]
+
 def quote_by_symbol(symbol):
   """Retrieve a quote by symbol."""
 
   return quotes_by_symbols([ symbol ])[0]
 
-def quotes_by_symbols(symbols, force_retrieve = False):
-  """Retrieve a quotes by a list of symbols."""
+def quotes_by_symbols(symbols, force_retrieve = False, background = False):
+  """Retrieve a quotes by a list of symbols. In background mode unknown and unpriced symbols are returned 
+     right away with their last known (or a placeholder) price, while their retrieval and any price history 
+     backfill are queued to the background workers."""
   
   # load or prime quotes for each symbol
   existing_quotes = dict([ (q.symbol, q) for q in Quote.objects.filter(symbol__in = symbols) ])
@@ -86,127 +267,304 @@ def quotes_by_symbols(symbols, force_retrieve = False):
       exists = False
             
     quotes[symbol] = quote
+    quote.pending = False
     if symbol == CASH_SYMBOL and not exists:
       quote.name = 'US Dollars'
       quote.price = 1.0
       quote.cash_equivalent = True
       quote.changed = True
       
-    elif not exists or force_retrieve:
+    elif not exists:
       quote.price = 0.0
       quote.changed = True
       symbols_to_retrieve.append(symbol)
       
     else:
       quote.changed = False
+      if force_retrieve or (background and not quote.cash_equivalent and quote.price == 0.0 and not _is_failed_symbol(symbol)):
+        symbols_to_retrieve.append(symbol)
   
-  # retrieve fresh prices from yahoo
-  if len(symbols_to_retrieve) > 0:
-    csv_url = ('http://download.finance.yahoo.com/d/quotes.csv?s=%s&f=sl1d1t1n&e=.csv' % (','.join(symbols_to_retrieve)))
-    csv_columns = 'symbol,price,date,time,name'
-    for row in _yql_csv_to_json(csv_url, csv_columns):
+  # retrieve fresh prices from yahoo, unless they are left to the background workers
+  if background:
+    for symbol in symbols_to_retrieve:
+      quotes[symbol].pending = True
+      
+  elif len(symbols_to_retrieve) > 0:
+    rows, unavailable = _retrieve_quote_rows(symbols_to_retrieve)
+    retrieved = set([])
+    for row in rows:
       price = row['price']
       tradeDate = row['date']
       tradeTime = row['time']
       
       quote = quotes.get(row['symbol'])
+      if quote == None or price == 'N/A':
+        continue
+      
+      quote.changed = True
       quote.cash_equivalent = price.endswith('%')
       quote.price = (1.0 if quote.cash_equivalent else float(price))
       quote.name = row['name']
+      if quote.price > 0.0:
+        retrieved.add(quote.symbol)
     
       if tradeDate != 'N/A' and tradeTime != 'N/A':
         month, day, year = [int(f) for f in tradeDate.split('/')]
-        time = datetime.strptime(tradeTime, '%I:%M%p')
-        quote.last_trade = datetime(year, month, day, time.hour, time.minute, time.second)
+        trade_time = datetime.strptime(tradeTime, '%I:%M%p')
+        quote.last_trade = datetime(year, month, day, trade_time.hour, trade_time.minute, trade_time.second)
+    
+    # symbols in chunks that could not be retrieved at all are not held against the symbol itself
+    for symbol in symbols_to_retrieve:
+      if symbol in retrieved:
+        _record_symbol_success(symbol)
+      elif symbol not in unavailable:
+        _record_symbol_failure(symbol)
         
   # save all changes
   for quote in quotes.values():
     if quote.changed:
       quote.save()
-    
-    if not quote.cash_equivalent and quote.price > 0.0 and quote.pricehistory_set.count() == 0:
-      refresh_price_history(quote)
+  
+  # backfill price history for priced quotes that have none, found with a single query
+  candidates = [ quote for quote in quotes.values() if not quote.cash_equivalent and quote.price > 0.0 and not _is_failed_symbol(quote.symbol) ]
+  with_history = set([])
+  if len(candidates) > 0:
+    with_history = set(PriceHistory.objects.filter(quote__id__in = [ quote.id for quote in candidates ]).values_list('quote', flat = True).distinct())
+  
+  for quote in candidates:
+    if quote.id not in with_history:
+      if background:
+        quote.pending = True
+        QUOTE_WORKERS.submit(('history', quote.symbol), _refresh_price_history_in_background, quote.id)
+      else:
+        try:
+          refresh_price_history(quote)
+        except IOError:
+          pass
+        
+  for symbol in (symbols_to_retrieve if background else []):
+    QUOTE_WORKERS.submit(('quote', symbol), _retrieve_quote_in_background, symbol)
     
   return quotes.values()
 
-def refresh_price_history(quote):
+def refresh_price_history(quote, full = False):
+  """Refresh the price history for a quote, either only the days since the latest stored price or, if full, 
+     the whole history window (which picks up dividend and split re-adjustments of older prices). The earliest
+     date with a changed price (or None) is left on the quote as history_changed_date."""
+  
+  quote.history_changed_date = None
   start_date = quote.last_trade + timedelta(days = 0 - PRICE_HISTORY_LIMIT_IN_DAYS)
+  if not full:
+    latest = list(quote.pricehistory_set.order_by('-as_of_date')[0:1])
+    if len(latest) > 0:
+      start_date = max(start_date, latest[0].as_of_date - timedelta(days = PRICE_HISTORY_OVERLAP_IN_DAYS))
+    
   end_date = quote.last_trade + timedelta(days = 1)
-  csv_columns = 'date,open,high,low,close,volume,adj_close'
-  csv_url = ('http://ichart.finance.yahoo.com/table.csv?s=%s&a=%.2d&b=%.2d&c=%.4d&d=%.2d&e=%.2d&f=%.4d&g=d&ignore=.csv' % (
-      quote.symbol, 
-      (start_date.month - 1), 
-      start_date.day, 
-      start_date.year, 
-      (end_date.month - 1), 
-      end_date.day, 
-      end_date.year)
-    )
 
   to_remove = { }
-  for history in quote.pricehistory_set.filter(as_of_date__gte = start_date.date()):
-    to_remove[history.as_of_date.date()] = history
+  for id, as_of_date, price in quote.pricehistory_set.filter(as_of_date__gte = start_date.date()).values_list('id', 'as_of_date', 'price'):
+    to_remove[as_of_date.date()] = (id, price)
 
-  to_save = []
-  for row in _yql_csv_to_json(csv_url, csv_columns, PRICE_HISTORY_LIMIT_IN_DAYS, 2):
+  # an empty history means the symbol is unknown or delisted, keep what is stored and back off
+  rows = get_quote_provider().price_history(quote.symbol, start_date, end_date)
+  if len(rows) == 0:
+    _record_symbol_failure(quote.symbol)
+    _set_history_date(quote)
+    return quote
+  
+  _record_symbol_success(quote.symbol)
+  to_insert = []
+  to_update = { }
+  changed_dates = []
+  for row in rows:
     as_of_date = datetime.strptime(row['date'], '%Y-%m-%d')
     price = float(row['adj_close'])
     
-    history = to_remove.get(as_of_date.date())
-    if history == None:
-      history = PriceHistory()
-      history.quote = quote
-      history.as_of_date = as_of_date
-      history.price = price
+    existing = to_remove.pop(as_of_date.date(), None)
+    if existing == None:
+      to_insert.append((quote.id, as_of_date, price))
+      changed_dates.append(as_of_date.date())
       
-    else:
-      del(to_remove[as_of_date.date()])
-      if abs(history.price - price) > 0.0001:
-        history.price = price
-      else:
-        continue
-
-    to_save.append(history)
+    elif abs(existing[1] - price) > 0.0001:
+      to_update[existing[0]] = price
+      changed_dates.append(as_of_date.date())
+  
+  changed_dates.extend(to_remove.keys())
+  if len(changed_dates) > 0:
+    quote.history_changed_date = min(changed_dates)
   
-  if len(to_remove) > 0:
-    ids = [ h.id for h in to_remove.values() ]
-    PriceHistory.objects.filter(id__in = ids).delete()
+  _save_price_history([ id for id, price in to_remove.values() ], to_insert, to_update)
+  invalidate_price_series(quote)
+  _invalidate_benchmark_series(quote.symbol)
+  _set_history_date(quote)
+  return quote
+
+#-----------------\
+#  VALUE OBJECTS  |
+#-----------------/
+
+class BenchmarkSeries:
+  def __init__(self, symbol, history_date, prices):
+    self.symbol = symbol
+    self.history_date = history_date
+    self.prices = prices
+    self.loaded = time()
     
-  if len(to_save) > 0:
-    for history in to_save:
-      history.save()
+  def __repr__(self):
+    return "BenchmarkSeries: %s, %d prices" % (self.symbol, len(self.prices))
+  
+  def price_on(self, as_of_date):
+    return self.prices.get(as_of_date, 0.0)
 
-  quote.history_date = datetime.now()
-  quote.save()
-  return quote
+class PriceSeries:
+  def __init__(self, dates, prices, history_date):
+    self.dates = dates
+    self.prices = prices
+    self.history_date = history_date
+    self.loaded = time()
+    
+  def __repr__(self):
+    return "PriceSeries: %d prices" % len(self.dates)
+  
+  def price_as_of(self, as_of):
+    index = bisect_right(self.dates, as_of.toordinal())
+    return (self.prices[index - 1] if index > 0 else 0)
+  
+  def is_expired(self, now):
+    return (now - self.loaded) > PRICE_SERIES_CACHE_TIMEOUT_IN_SECONDS
 
 #-------------------\
 #  LOCAL FUNCTIONS  |
 #-------------------/
 
-def _yql_csv_to_json(csv_url, csv_columns, limit = None, offset = None):
-  u = None
+def _invalidate_benchmark_series(symbol):
+  BENCHMARK_SERIES_CACHE_LOCK.acquire()
+  try:
+    for key in [ key for key in BENCHMARK_SERIES_CACHE.keys() if key[0] == symbol ]:
+      del(BENCHMARK_SERIES_CACHE[key])
+  finally:
+    BENCHMARK_SERIES_CACHE_LOCK.release()
+
+def _shared_benchmark_key(series, start_date):
+  # keyed by the history date too, so a refreshed price history is never served from the shared cache
+  return 'frano.benchmark.%s.%s.%s' % (
+      series.symbol,
+      (start_date.strftime('%Y%m%d') if start_date != None else 'all'),
+      (series.history_date.strftime('%Y%m%d%H%M%S') if series.history_date != None else 'none'),
+    )
+
+def _set_history_date(quote):
+  # update only the history date, to not overwrite prices refreshed concurrently by other processes
+  quote.history_date = datetime.now().replace(microsecond = 0)
+  Quote.objects.filter(id = quote.id).update(history_date = quote.history_date)
+
+def _trim_benchmark_series_cache():
+  overflow = len(BENCHMARK_SERIES_CACHE) - BENCHMARK_SERIES_CACHE_SIZE
+  if overflow > 0:
+    oldest = sorted(BENCHMARK_SERIES_CACHE.items(), key = (lambda item: item[1].loaded))[0:overflow]
+    for key, series in oldest:
+      del(BENCHMARK_SERIES_CACHE[key])
+
+def _trim_price_series_cache():
+  overflow = len(PRICE_SERIES_CACHE) - PRICE_SERIES_CACHE_SIZE
+  if overflow > 0:
+    oldest = sorted(PRICE_SERIES_CACHE.items(), key = (lambda item: item[1].loaded))[0:overflow]
+    for id, series in oldest:
+      del(PRICE_SERIES_CACHE[id])
+
+def _retrieve_quote_in_background(symbol):
+  quotes_by_symbols([ symbol ], force_retrieve = True)
+  
+def _refresh_price_history_in_background(quote_id):
+  candidates = Quote.objects.filter(id = quote_id)
+  if candidates.count() == 1:
+    refresh_price_history(candidates[0])
+
+@transaction.commit_on_success
+def _save_price_history(ids_to_remove, rows_to_insert, prices_to_update):
+  bulk_delete(PriceHistory._meta.db_table, ids_to_remove)
+  bulk_insert(PriceHistory._meta.db_table, [ 'quote_id', 'as_of_date', 'price' ], rows_to_insert)
+  bulk_update(PriceHistory._meta.db_table, 'price', prices_to_update)
+
+def _is_failed_symbol(symbol):
+  FAILED_SYMBOLS_LOCK.acquire()
   try:
+    failure = FAILED_SYMBOLS.get(symbol)
+    return (failure != None and failure[1] > time())
+  finally:
+    FAILED_SYMBOLS_LOCK.release()
     
-    yql_suffix = ''
-    if limit != None and offset != None:
-      yql_suffix = yql_suffix + (' limit %d offset %d' % (limit, offset))
+def _record_symbol_failure(symbol):
+  FAILED_SYMBOLS_LOCK.acquire()
+  try:
+    failures = FAILED_SYMBOLS.get(symbol, (0, None))[0] + 1
+    backoff = min(FAILED_SYMBOL_BACKOFF_IN_SECONDS * (2 ** (failures - 1)), FAILED_SYMBOL_MAX_BACKOFF_IN_SECONDS)
+    FAILED_SYMBOLS[symbol] = (failures, time() + backoff)
+  finally:
+    FAILED_SYMBOLS_LOCK.release()
+
+def _record_symbol_success(symbol):
+  FAILED_SYMBOLS_LOCK.acquire()
+  try:
+    FAILED_SYMBOLS.pop(symbol, None)
+  finally:
+    FAILED_SYMBOLS_LOCK.release()
+
+def _retrieve_quote_rows(symbols):
+  chunks = [ symbols[i:(i + QUOTE_FETCH_CHUNK_SIZE)] for i in range(0, len(symbols), QUOTE_FETCH_CHUNK_SIZE) ]
+  
+  rows = []
+  unavailable = set([])
+  for chunk, chunk_rows in zip(chunks, _map_in_parallel(_retrieve_quote_chunk, chunks, QUOTE_FETCH_THREADS)):
+    if chunk_rows != None:
+      rows.extend(chunk_rows)
+    else:
+      unavailable.update(chunk)
     
-    yql_query = ("select * from csv where url='%s' and columns='%s' %s" % (csv_url, csv_columns, yql_suffix))
-    u = urlopen('http://query.yahooapis.com/v1/public/yql?q=%s&format=json&callback=' % quote_plus(yql_query))
+  return (rows, unavailable)
+
+def _retrieve_quote_chunk(symbols):
+  attempt = 0
+  while True:
+    try:
+      return get_quote_provider().quotes(symbols)
     
-    packet = json.loads(u.read())
-    out = [ ]
-    if packet.has_key('query'):
-      count = packet['query']['count']
-      if count == 1:
-        out.append(packet['query']['results']['row'])
-      elif count > 0:
-        out = packet['query']['results']['row']
+    except ProviderUnavailableError:
+      return None
     
-    return out
+    except (IOError, ValueError, KeyError):
+      # a failed chunk leaves its quotes untouched rather than failing the whole retrieval
+      if attempt >= QUOTE_FETCH_RETRIES:
+        return None
+      
+      attempt += 1
+      sleep(QUOTE_FETCH_RETRY_DELAY_IN_SECONDS * attempt)
 
-  finally:
-    if u != None:
-      u.close()
-      
\ No newline at end of file
+def _map_in_parallel(function, items, threads):
+  results = [ None ] * len(items)
+  if len(items) == 1:
+    results[0] = function(items[0])
+    return results
+  
+  pending = Queue()
+  for index, item in enumerate(items):
+    pending.put((index, item))
+    
+  def work():
+    while True:
+      try:
+        index, item = pending.get_nowait()
+      except Empty:
+        return
+      
+      results[index] = function(item)
+  
+  workers = [ Thread(target = work) for i in range(min(threads, len(items))) ]
+  for worker in workers:
+    worker.setDaemon(True)
+    worker.start()
+    
+  for worker in workers:
+    worker.join()
+    
+  return results
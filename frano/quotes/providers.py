@@ -0,0 +1,314 @@
+# Copyright (c) 2011 Gennadiy Shafranovich
+# Licensed under the MIT license
+# see LICENSE file for copying permission.
+
+import json
+
+from errno import ECONNRESET
+from errno import EPIPE
+from httplib import BadStatusLine
+from httplib import HTTPConnection
+from httplib import HTTPException
+from Queue import Empty
+from Queue import Full
+from Queue import Queue
+from socket import error as SocketError
+from threading import Lock
+from time import sleep
+from time import time
+from urllib import quote_plus
+
+from settings import QUOTE_PROVIDER
+from settings import QUOTE_PROVIDER_FIXTURE
+from settings import QUOTE_PROVIDER_LATENCY_IN_SECONDS
+
+#-------------\
+#  CONSTANTS  |
+#-------------/
+
+YQL_HOST = 'query.yahooapis.com'
+YQL_PATH = '/v1/public/yql?q=%s&format=json&callback='
+
+# number of idle keep-alive connections kept open to the provider, and the timeout of each request
+PROVIDER_CONNECTION_POOL_SIZE = 8
+PROVIDER_TIMEOUT_IN_SECONDS = 15
+
+# after this many consecutive failures the provider is considered down, and calls fail fast until the cooldown passes
+PROVIDER_FAILURE_THRESHOLD = 5
+PROVIDER_COOLDOWN_IN_SECONDS = 60
+
+# the provider in use, created on first use from the QUOTE_PROVIDER setting
+PROVIDER = None
+PROVIDER_LOCK = Lock()
+
+#------------\
+#  SERVICES  |
+#------------/
+
+def get_quote_provider():
+  """Get the quote provider configured by the QUOTE_PROVIDER setting (YAHOO or LOCAL)."""
+
+  global PROVIDER
+  PROVIDER_LOCK.acquire()
+  try:
+    if PROVIDER == None:
+      provider = None
+      if QUOTE_PROVIDER == 'LOCAL':
+        provider = LocalQuoteProvider(QUOTE_PROVIDER_FIXTURE, QUOTE_PROVIDER_LATENCY_IN_SECONDS)
+      else:
+        provider = YahooQuoteProvider(PROVIDER_CONNECTION_POOL_SIZE, PROVIDER_TIMEOUT_IN_SECONDS)
+        
+      PROVIDER = CircuitBreakerQuoteProvider(provider, PROVIDER_FAILURE_THRESHOLD, PROVIDER_COOLDOWN_IN_SECONDS)
+
+    return PROVIDER
+
+  finally:
+    PROVIDER_LOCK.release()
+
+def record_quote_fixture(provider, symbols, start_date, end_date):
+  """Record the quotes and price history of the given symbols from a provider, in the fixture format
+     replayed by the LocalQuoteProvider."""
+
+  fixture = { 'quotes' : { }, 'history' : { } }
+  for row in provider.quotes(symbols):
+    fixture['quotes'][row['symbol']] = row
+
+  for symbol in symbols:
+    fixture['history'][symbol] = provider.price_history(symbol, start_date, end_date)
+
+  return fixture
+
+#-----------------\
+#  VALUE OBJECTS  |
+#-----------------/
+
+class QuoteProvider:
+  """Source of market data. Quote rows are dictionaries with symbol, price, date (m/d/Y), time (I:Mp) and
+     name, all as strings. Price history rows are dictionaries with at least a date (Y-m-d) and adj_close,
+     newest first."""
+
+  def quotes(self, symbols):
+    raise NotImplementedError()
+
+  def price_history(self, symbol, start_date, end_date):
+    raise NotImplementedError()
+
+class YahooQuoteProvider(QuoteProvider):
+  def __init__(self, pool_size, timeout):
+    self.pool = HttpConnectionPool(YQL_HOST, pool_size, timeout)
+
+  def __repr__(self):
+    return "YahooQuoteProvider: %s" % self.pool
+
+  def quotes(self, symbols):
+    csv_url = ('http://download.finance.yahoo.com/d/quotes.csv?s=%s&f=sl1d1t1n&e=.csv' % (','.join(symbols)))
+    csv_columns = 'symbol,price,date,time,name'
+    return self._yql_csv_to_json(csv_url, csv_columns)
+
+  def price_history(self, symbol, start_date, end_date):
+    csv_columns = 'date,open,high,low,close,volume,adj_close'
+    csv_url = ('http://ichart.finance.yahoo.com/table.csv?s=%s&a=%.2d&b=%.2d&c=%.4d&d=%.2d&e=%.2d&f=%.4d&g=d&ignore=.csv' % (
+        symbol,
+        (start_date.month - 1),
+        start_date.day,
+        start_date.year,
+        (end_date.month - 1),
+        end_date.day,
+        end_date.year)
+      )
+
+    return self._yql_csv_to_json(csv_url, csv_columns, ((end_date - start_date).days + 1), 2)
+
+  def _yql_csv_to_json(self, csv_url, csv_columns, limit = None, offset = None):
+    yql_suffix = ''
+    if limit != None and offset != None:
+      yql_suffix = yql_suffix + (' limit %d offset %d' % (limit, offset))
+
+    yql_query = ("select * from csv where url='%s' and columns='%s' %s" % (csv_url, csv_columns, yql_suffix))
+    packet = json.loads(self.pool.get(YQL_PATH % quote_plus(yql_query)))
+    out = [ ]
+    if packet.has_key('query'):
+      count = packet['query']['count']
+      if count == 1:
+        out.append(packet['query']['results']['row'])
+      elif count > 0:
+        out = packet['query']['results']['row']
+
+    return out
+
+class LocalQuoteProvider(QuoteProvider):
+  """Replays quotes and price history recorded in a JSON fixture file (see record_quote_fixture), waiting
+     a configurable latency on every call, for offline load tests and reproducible benchmarks."""
+
+  def __init__(self, fixture_path, latency):
+    self.latency = latency
+    self.fixture = { 'quotes' : { }, 'history' : { } }
+    if fixture_path != None:
+      f = open(fixture_path)
+      try:
+        self.fixture.update(json.load(f))
+      finally:
+        f.close()
+
+  def __repr__(self):
+    return "LocalQuoteProvider: %d quotes, %.3fs latency" % (len(self.fixture['quotes']), self.latency)
+
+  def quotes(self, symbols):
+    self._wait()
+    return [ self.fixture['quotes'][symbol] for symbol in symbols if self.fixture['quotes'].has_key(symbol) ]
+
+  def price_history(self, symbol, start_date, end_date):
+    self._wait()
+    start = start_date.strftime('%Y-%m-%d')
+    end = end_date.strftime('%Y-%m-%d')
+    return [ row for row in self.fixture['history'].get(symbol, []) if start <= row['date'] <= end ]
+
+  def _wait(self):
+    if self.latency > 0:
+      sleep(self.latency)
+
+class CircuitBreakerQuoteProvider(QuoteProvider):
+  """Wraps another provider and stops calling it after a run of consecutive failures, raising 
+     ProviderUnavailableError right away until a cooldown passes. After the cooldown a single trial
+     call is let through, closing the circuit again if it succeeds."""
+  
+  def __init__(self, provider, threshold, cooldown):
+    self.provider = provider
+    self.threshold = threshold
+    self.cooldown = cooldown
+    self.lock = Lock()
+    self.failures = 0
+    self.opened = None
+    self.trial = False
+    
+  def __repr__(self):
+    return "CircuitBreakerQuoteProvider: %s (%s)" % (self.provider, ('open' if self.opened != None else 'closed'))
+  
+  def quotes(self, symbols):
+    return self._call(self.provider.quotes, symbols)
+  
+  def price_history(self, symbol, start_date, end_date):
+    return self._call(self.provider.price_history, symbol, start_date, end_date)
+  
+  def _call(self, function, *args):
+    self.lock.acquire()
+    try:
+      if self.opened != None:
+        if self.trial or (time() - self.opened) < self.cooldown:
+          raise ProviderUnavailableError('Quote provider unavailable after %d consecutive failures' % self.failures)
+        
+        self.trial = True
+    finally:
+      self.lock.release()
+    
+    try:
+      out = function(*args)
+      
+    except (IOError, ValueError):
+      self.lock.acquire()
+      try:
+        self.failures += 1
+        self.trial = False
+        if self.failures >= self.threshold:
+          self.opened = time()
+      finally:
+        self.lock.release()
+        
+      raise
+    
+    except:
+      # anything else is not the provider failing, but the trial is over all the same
+      self.lock.acquire()
+      try:
+        self.trial = False
+      finally:
+        self.lock.release()
+        
+      raise
+    
+    self.lock.acquire()
+    try:
+      self.failures = 0
+      self.opened = None
+      self.trial = False
+    finally:
+      self.lock.release()
+    
+    return out
+
+class ProviderUnavailableError(IOError):
+  pass
+
+class HttpConnectionPool:
+  """A bounded pool of idle keep-alive HTTP connections to a single host, safe to share between threads."""
+
+  def __init__(self, host, size, timeout):
+    self.host = host
+    self.timeout = timeout
+    self.idle = Queue(size)
+
+  def __repr__(self):
+    return "HttpConnectionPool: %s (%d idle)" % (self.host, self.idle.qsize())
+
+  def get(self, path):
+    """Issue a GET for the given path, returning the response body. Failures are raised as IOError."""
+
+    connection = self._checkout()
+    try:
+      try:
+        status, body, will_close = self._request(connection, path)
+
+      except (HTTPException, SocketError), e:
+        # an idle connection may have been dropped by the server since its last use, retry once on a fresh one.
+        # Other failures (timeouts in particular) are not retried, to keep requests within the timeout
+        if not self._is_stale_connection_error(e):
+          raise
+
+        connection.close()
+        connection = self._connect()
+        status, body, will_close = self._request(connection, path)
+
+    except HTTPException, e:
+      connection.close()
+      raise IOError('HTTP failure from %s: %s' % (self.host, e))
+
+    except:
+      connection.close()
+      raise
+
+    if will_close:
+      connection.close()
+    else:
+      self._checkin(connection)
+
+    if status != 200:
+      raise IOError('HTTP status %d from %s' % (status, self.host))
+
+    return body
+
+  def _is_stale_connection_error(self, e):
+    if isinstance(e, BadStatusLine):
+      return True
+
+    return (isinstance(e, SocketError) and e.errno in [ ECONNRESET, EPIPE ])
+
+  def _request(self, connection, path):
+    connection.request('GET', path, headers = { 'Connection' : 'keep-alive' })
+    response = connection.getresponse()
+    body = response.read()
+    return (response.status, body, response.will_close)
+
+  def _connect(self):
+    return HTTPConnection(self.host, timeout = self.timeout)
+
+  def _checkout(self):
+    try:
+      return self.idle.get_nowait()
+    except Empty:
+      return self._connect()
+
+  def _checkin(self, connection):
+    try:
+      self.idle.put_nowait(connection)
+    except Full:
+      connection.close()
@@ -45,6 +45,21 @@ INSTALLED_APPS = (
 SESSION_ENGINE = 'django.contrib.sessions.backends.db'
 SESSION_EXPIRE_AT_BROWSER_CLOSE = True
 
+# market data provider, either YAHOO or LOCAL (replays a fixture recorded with the 
+# benchmark_quote_provider command, waiting the given latency on every call)
+QUOTE_PROVIDER = 'YAHOO'
+QUOTE_PROVIDER_FIXTURE = None
+QUOTE_PROVIDER_LATENCY_IN_SECONDS = 0.0
+
+# engine computing daily portfolio values, either SQL (a single query, MySQL only) or PYTHON (array 
+# operations over the stored positions and price history, any database, needs NumPy)
+PERFORMANCE_HISTORY_ENGINE = 'SQL'
+
+# benchmarks plotted against portfolio performance, their price series are cached in each process and, 
+# when a cache backend is given (e.g. memcached://127.0.0.1:11211/), shared between processes through it
+PERFORMANCE_BENCHMARK_SYMBOLS = [ 'ACWI' ]
+PERFORMANCE_BENCHMARK_CACHE_BACKEND = None
+
 # load external settings
 settings_dir = os.path.realpath(os.path.dirname(__file__))
 settings_files = glob.glob(os.path.join(settings_dir, 'settings/*.py'))
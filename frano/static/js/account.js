@@ -26,6 +26,10 @@ $(function() {
     }
   });
   
+  $(".lotReliefMethod").change(function (e) {
+    $(this).parents("FORM").submit();
+  });
+  
   $(".removePortfolioButton").click(function (e) {
     if(!confirm('Are you sure you want to remove this portfolio?\nNOTE: This cannot be undone...sorry.')) {
       e.preventDefault();
@@ -19,29 +19,33 @@ $(function() {
 
 function initializeProfitLossChart(container) {
   var dataPercent = []
-  var benchmarkPercent = []
   for(var i = 0; i < performance.length; i++) {
-    dataPercent[i] = [ i, performance[i] ]
-    benchmarkPercent[i] = [ i, benchmark[i] ]
+    dataPercent[i] = [ dates[i], performance[i] ]
   }
   
+  var series = [ { data: dataPercent, yaxis: 2, label: "Performance %" } ]
+  for(var b = 0; b < benchmarkSymbols.length; b++) {
+    var benchmarkPercent = []
+    for(var i = 0; i < benchmarks.length; i++) {
+      benchmarkPercent[i] = [ dates[i], benchmarks[i][b] ]
+    }
+    
+    series[series.length] = { data: benchmarkPercent, yaxis: 2, label: 'Benchmark (' + benchmarkSymbols[b] + ')' }
+  }
+  
+  // points are placed by date (downsampled ranges are unevenly spaced), long ranges are labeled by month
+  var longRange = (dates.length > 1 && (dates[dates.length - 1] - dates[0]) > (366 * 24 * 60 * 60 * 1000));
+  
   $.plot(container,
-    [ 
-      { data: dataPercent, yaxis: 2, label: "Performance %" },
-      { data: benchmarkPercent, yaxis: 2, label: 'Benchmark (' + benchmarkSymbol + ')' }
-    ],
+    series,
     {
       series: {
         lines: { show: true }
       },
       xaxis: {
-        ticks: dates.length / 7,
-        minTickSize: 1,
-        tickFormatter: function (value, axis) {
-          if(value >= 0 && value < dates.length) {
-            return $.datepicker.formatDate('mm/dd', dates[value]);
-          }
-        }
+        mode: "time",
+        timeformat: (longRange ? "%b %y" : "%m/%d"),
+        ticks: 13
       },
       y2axis: {
         tickFormatter: function (value, axis) {
@@ -7,6 +7,7 @@ from exceptions import Exception
 
 from django import forms
 from django.core.mail import EmailMessage
+from django.db.transaction import commit_on_success
 from django.forms.formsets import formset_factory
 from django.http import HttpResponse
 from django.template.loader import render_to_string
@@ -19,7 +20,7 @@ from models import Transaction
 from models import detect_transaction_file_type
 from models import parse_transactions
 from models import transactions_as_csv
-from positions.models import refresh_positions
+from positions.models import refresh_positions_in_background
 from quotes.models import CASH_SYMBOL
 from quotes.models import quote_by_symbol
 
@@ -55,6 +56,7 @@ def transactions(request, portfolio, is_sample, read_only):
   return render_page('transactions.html', request, portfolio = portfolio, extra_dictionary = context)
   
 @portfolio_manipulation_decorator
+@commit_on_success
 def add(request, portfolio, is_sample, read_only):
   form = TransactionForm(request.POST)
   if form.is_valid():
@@ -84,27 +86,30 @@ def add(request, portfolio, is_sample, read_only):
       transaction.linked_symbol = linked_symbol
       transaction.save()
     
-      refresh_positions(portfolio, force = True)
+      refresh_positions_in_background(portfolio, transaction.as_of_date)
   
   return redirect_to_portfolio_action('transactions', portfolio)
 
 @portfolio_manipulation_decorator
+@commit_on_success
 def remove(request, portfolio, is_sample, read_only, transaction_id):
   transaction = Transaction.objects.filter(id = transaction_id)[0]
   if transaction.portfolio.id == portfolio.id:
     transaction.delete()
-    refresh_positions(portfolio, force = True)
+    refresh_positions_in_background(portfolio, transaction.as_of_date)
     
   return redirect_to_portfolio_action('transactions', portfolio) 
 
 @portfolio_manipulation_decorator
+@commit_on_success
 def remove_all(request, portfolio, is_sample, read_only):
   Transaction.objects.filter(portfolio__id__exact = portfolio.id).delete()
-  refresh_positions(portfolio, force = True)
+  refresh_positions_in_background(portfolio)
     
   return redirect_to_portfolio_action('importTransactions', portfolio)
 
 @portfolio_manipulation_decorator
+@commit_on_success
 def update(request, portfolio, is_sample, read_only, transaction_id):
   transaction = Transaction.objects.filter(id = transaction_id)[0]
   success = False
@@ -112,6 +117,7 @@ def update(request, portfolio, is_sample, read_only, transaction_id):
     form = UpdateTransactionForm(request.POST)
     if form.is_valid():
       current_commission = transaction.total - (transaction.price * transaction.quantity)
+      original_as_of_date = transaction.as_of_date
       
       type = form.get_if_present('type')
       if type != None and type != '':
@@ -146,7 +152,7 @@ def update(request, portfolio, is_sample, read_only, transaction_id):
         transaction.linked_symbol = (linked_symbol.encode('UTF-8').upper() if linked_symbol.strip() != '' else None)
       
       transaction.save()
-      refresh_positions(portfolio, force = True)
+      refresh_positions_in_background(portfolio, min(original_as_of_date, transaction.as_of_date))
       success = True
     
   return HttpResponse("{ \"success\": \"%s\" }" % success)
@@ -222,11 +228,13 @@ def import_form(request, portfolio, is_sample, read_only):
   return render_page('importTransactions.html', request, portfolio = portfolio, extra_dictionary = context)  
 
 @portfolio_manipulation_decorator
+@commit_on_success
 def process_import(request, portfolio, is_sample, read_only):
   formset = ImportTransactionFormSet(request.POST)
   if not formset.is_valid():
     raise Exception('Invalid import set');
   
+  imported_dates = []
   for form in formset.forms:
     cd = form.cleaned_data
     
@@ -245,8 +253,11 @@ def process_import(request, portfolio, is_sample, read_only):
         transaction.linked_symbol = linked_symbol
         
       transaction.save()
+      imported_dates.append(transaction.as_of_date)
+    
+  if len(imported_dates) > 0:
+    refresh_positions_in_background(portfolio, min(imported_dates))
     
-  refresh_positions(portfolio, force = True)
   return redirect_to_portfolio_action('transactions', portfolio)
 
 @portfolio_manipulation_decorator
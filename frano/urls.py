@@ -31,6 +31,7 @@ urlpatterns += patterns('frano.account.views',
   (r'^removeAccount.html', 'remove'),
   (r'^createPortfolio.html', 'new_portfolio'),
   (r'^(?P<portfolio_id>\d+)/setName.html', 'set_portfolio_name'),
+  (r'^(?P<portfolio_id>\d+)/setLotReliefMethod.html', 'set_lot_relief_method'),
   (r'^(?P<portfolio_id>\d+)/remove.html', 'remove_portfolio'),  
 )
 